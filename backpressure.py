@@ -0,0 +1,98 @@
+import contextvars
+import threading
+import time
+from requests.exceptions import HTTPError
+from loguru import logger
+
+LOG = logger.debug
+
+# Plugin instance states of jobs queued in CUBE but not running yet
+PENDING_STATES = ("created", "waiting", "scheduled")
+
+
+class BackpressureGate:
+    """
+    Hold new workflow submissions while CUBE's compute queue is deep.
+
+    The pending-job depth is sampled at most every ``interval`` seconds:
+    the CUBE-wide count of created, waiting and scheduled plugin instances
+    where the API reports collection totals, otherwise the pending jobs of
+    the workflows submitted through the gate. Between samples the jobs of
+    new submissions are added to the last sample, which is also kept if
+    sampling fails. Submissions wait while the depth exceeds
+    ``max_pending``.
+    """
+
+    def __init__(self, context, max_pending: int, interval: float = 30):
+        self.context = context
+        self.max_pending = max_pending
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.workflows = set()
+        self.depth = 0
+        self.sampled = None
+        self.cube_wide = True
+        self.pipe = None
+
+    def add(self, workflow_id: int, jobs: int):
+        """
+        Account for a submitted workflow of ``jobs`` plugin instances
+        """
+        with self.lock:
+            self.workflows.add(workflow_id)
+            self.depth += jobs
+
+    def sample(self) -> int:
+        if self.pipe is None:
+            from pipeline import Pipeline
+            self.pipe = Pipeline(self.context.api_base, self.context.token, context=self.context)
+
+        if self.cube_wide:
+            total = self.pipe.count_plugin_instances(PENDING_STATES)
+            if total is not None:
+                return total
+            LOG("CUBE reports no collection totals, sampling the submitted workflows")
+            self.cube_wide = False
+
+        depth = 0
+        for workflow_id in list(self.workflows):
+            try:
+                pending = self.pipe._get_workflow_status(workflow_id)["pending_jobs"]
+            except HTTPError as ex:
+                if ex.response is None or ex.response.status_code != 404:
+                    raise
+                # deleted workflow
+                pending = 0
+            if pending:
+                depth += pending
+            else:
+                # all nodes of a workflow are created at once, none will queue again
+                self.workflows.discard(workflow_id)
+        return depth
+
+    def pending(self) -> int:
+        """
+        Current pending-job depth, resampled once ``interval`` has passed
+        """
+        with self.lock:
+            if self.sampled is None or time.monotonic() - self.sampled >= self.interval:
+                try:
+                    # outside the row deadline of the submitting caller
+                    self.depth = contextvars.Context().run(self.sample)
+                except Exception as ex:
+                    LOG(f"Could not sample the pending jobs, keeping {self.depth}: {ex}")
+                self.sampled = time.monotonic()
+            return self.depth
+
+    def wait(self):
+        """
+        Block while the pending-job depth is above the threshold
+        """
+        depth = self.pending()
+        if depth <= self.max_pending:
+            return
+        LOG(f"{depth} jobs pending in CUBE, holding new workflows")
+        start = time.monotonic()
+        while self.pending() > self.max_pending:
+            time.sleep(self.interval)
+        LOG(f"Resuming workflow submission after {time.monotonic() - start:.0f}s")
@@ -2,34 +2,35 @@
 
 from base_client import BaseClient
 import json
+import os
 import requests
 from loguru import logger
-import sys
+import asyncio
+import concurrent.futures
+from urllib.parse import urlencode
 from pipeline import Pipeline
 from notification import Notification
+from context import RunContext
 LOG = logger.debug
 
-logger_format = (
-    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> │ "
-    "<level>{level: <5}</level> │ "
-    "<yellow>{name: >28}</yellow>::"
-    "<cyan>{function: <30}</cyan> @"
-    "<cyan>{line: <4}</cyan> ║ "
-    "<level>{message}</level>"
-)
-logger.remove()
-logger.add(sys.stderr, format=logger_format)
+ANONYMIZE_PIPELINE = "PACS query, retrieve, registration verification, and run pipeline in CUBE 20250806"
+NEURO_PIPELINE = "DICOM anonymization, niftii conversion, and push to neuro tree v20250326"
+# Stage of a row that each pipeline stands for in the metrics store
+PIPELINE_STAGES = {ANONYMIZE_PIPELINE: "retrieve", NEURO_PIPELINE: "anonymize"}
 
 class ChrisClient(BaseClient):
-    def __init__(self, url: str, token: str):
-        self.api_base = url.rstrip('/')
+    def __init__(self, url: str, token: str, cache=None, context: RunContext = None):
+        self.context = context or RunContext(url, token, cache=cache)
+        self.api_base = self.context.api_base
         self.auth = token
-        self.headers = {"Content-Type": "application/json", "Authorization": f"Token {token}"}
-        self.pacs_series_url = f"{url}/pacs/series/"
+        self.cache = self.context.cache
+        self.headers = self.context.headers
+        self.session = self.context.session
+        self.pacs_series_url = f"{self.api_base}/pacs/series/"
 
     def health_check(self):
         endpoint = f"{self.api_base}/"
-        response = requests.request("GET", endpoint, headers=self.headers, timeout=30)
+        response = self.session.request("GET", endpoint, headers=self.headers, timeout=30)
 
         response.raise_for_status()
 
@@ -38,17 +39,90 @@ class ChrisClient(BaseClient):
         except ValueError:
             return response.text
 
+    def get_registered_series(self, l_filter: list[dict], max_workers: int = 4) -> dict:
+        """
+        Bulk query CUBE's PACS series index and map every registered
+        SeriesInstanceUID to its folder path in CUBE. Each filter
+        (e.g. ``{"PatientID": ...}``) is paged through concurrently.
+        """
+        def query(d_filter: dict) -> dict:
+            d_series = {}
+            url = f"{self.pacs_series_url}search/?{urlencode({**d_filter, 'limit': 100})}"
+            while url:
+                response = self.session.request("GET", url, headers=self.headers, timeout=30)
+                response.raise_for_status()
+                collection = response.json().get("collection", {})
+                for item in collection.get("items", []):
+                    d_data = {field.get("name"): field.get("value") for field in item.get("data", [])}
+                    if d_data.get("SeriesInstanceUID"):
+                        d_series[d_data["SeriesInstanceUID"]] = d_data.get("folder_path", "")
+                url = next((link.get("href") for link in collection.get("links", [])
+                            if link.get("rel") == "next"), None)
+            return d_series
+
+        d_registered = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for d_series in executor.map(query, l_filter):
+                d_registered.update(d_series)
+        return d_registered
+
+    def get_series_progress(self, l_uid: list[str], max_workers: int = 4) -> dict:
+        """
+        Map every SeriesInstanceUID to the number of its files registered
+        in CUBE so far and the folder path holding them
+        """
+        def progress(uid: str) -> tuple:
+            url = f"{self.api_base}/pacs/files/search/?{urlencode({'SeriesInstanceUID': uid, 'limit': 1})}"
+            response = self.session.request("GET", url, headers=self.headers, timeout=30)
+            response.raise_for_status()
+            collection = response.json().get("collection", {})
+            folder_path = ""
+            for item in collection.get("items", []):
+                d_data = {field.get("name"): field.get("value") for field in item.get("data", [])}
+                folder_path = os.path.dirname(d_data.get("fname", ""))
+            return uid, (collection.get("total", 0), folder_path)
+
+        d_progress = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            for future in [executor.submit(progress, uid) for uid in l_uid]:
+                try:
+                    uid, d_progress[uid] = future.result()
+                except Exception as ex:
+                    LOG(f"Could not get the registration progress of a series: {ex}")
+        return d_progress
+
     def pacs_pull(self):
         pass
     def pacs_push(self):
         pass
     async def anonymize(self, params: dict, pv_id: int):
-        pipe = Pipeline(self.api_base, self.auth)
-        plugin_params = {
+        pipe = Pipeline(self.api_base, self.auth, context=self.context)
+        d_ret = await pipe.run_pipeline(
+            previous_inst = pv_id,
+            pipeline_name = ANONYMIZE_PIPELINE,
+            pipeline_params = self._anonymize_params(params) )
+        return d_ret
+
+    async def anonymize_batch(self, l_params: list[dict], pv_id: int, max_workers: int = 4) -> list[dict]:
+        """
+        Submit the PACS query/retrieve workflows of several jobs at once.
+        Statuses are returned in the order of ``l_params``.
+        """
+        pipe = Pipeline(self.api_base, self.auth, context=self.context)
+        return await pipe.run_pipelines(
+            pipeline_name = ANONYMIZE_PIPELINE,
+            l_pipeline = [(pv_id, self._anonymize_params(params)) for params in l_params],
+            max_workers = max_workers )
+
+    def _anonymize_params(self, params: dict) -> dict:
+        """
+        Build the plugin parameters of the anonymization pipeline for a job
+        """
+        return {
             'PACS-query': {
                 "PACSurl": params["pull"]["url"],
                 "PACSname": params["pull"]["pacs"],
-                "PACSdirective": json.dumps(params["search"])
+                "PACSdirective": json.dumps(dict(params["search"]))
             },
             'PACS-retrieve': {
                 "PACSurl": params["pull"]["url"],
@@ -71,21 +145,15 @@ class ChrisClient(BaseClient):
                 "largeSequencePollInterval": params["relay"]["largeSequencePollInterval"],
             }
         }
-        d_ret = await pipe.run_pipeline(
-            previous_inst = pv_id,
-            pipeline_name = "PACS query, retrieve, registration verification, and run pipeline in CUBE 20250806",
-            pipeline_params = plugin_params )
-        return d_ret
 
     async def neuro_pull(self, neuro_location: str, feed_name: str, filter_str: str, job_params: dict):
         """
         1. Pull data from the neuro tree
         2. Run anonymization pipeline to the root node
         """
-        send_params: dict = job_params["push"]
         LOG(f"Pulling {filter_str} from {neuro_location}")
 
-        ntf = Notification(self.api_base, self.auth)
+        ntf = Notification(self.api_base, self.auth, context=self.context)
         neuro_plugin_id = ntf.get_plugin_id({"name": "pl-neurofiles-pull"})
 
         # Run pl-neuro_pull using filters
@@ -98,12 +166,98 @@ class ChrisClient(BaseClient):
         LOG(f"Created new analysis: {feed_name}")
 
         # Run anonymization pipeline
-        pipe = Pipeline(self.api_base, self.auth)
-        plugin_params = {
+        return await self.run_neuro_pipeline(neuro_inst_id, job_params)
+
+    async def registered_pull(self, l_folder_path: list[str], feed_name: str, job_params: dict):
+        """
+        1. Copy already registered PACS series into a new analysis
+        2. Run anonymization pipeline to the root node
+        """
+        LOG(f"Series already registered in CUBE, copying {l_folder_path}")
+
+        ntf = Notification(self.api_base, self.auth, context=self.context)
+        dircopy_plugin_id = ntf.get_plugin_id({"name": "pl-dircopy"})
+        copy_inst_id = ntf.create_plugin_instance(dircopy_plugin_id,
+                                                  {
+                                                   "dir": ",".join(l_folder_path),
+                                                   "title": feed_name}
+                                                  )
+        LOG(f"Created new analysis: {feed_name}")
+
+        return await self.run_neuro_pipeline(copy_inst_id, job_params)
+
+    async def neuro_pull_batch(self, l_request: list[tuple], max_workers: int = 4) -> list[dict]:
+        """
+        Run the neuro branch of many jobs as one stage:
+        1. Group requests pulling the same files from the same location
+           (rows of one study share a study-wide filter, see ``neuro_filters``)
+        2. Create one pl-neurofiles-pull instance per group, concurrently
+        3. Submit the anonymization workflows of a group as soon as its
+           instance ID is known
+
+        ``l_request`` holds (neuro_location, feed_name, filter_str, job_params)
+        tuples; statuses are returned in the same order.
+        """
+        ntf = Notification(self.api_base, self.auth, context=self.context)
+        pipe = Pipeline(self.api_base, self.auth, context=self.context)
+        l_ret = [{}] * len(l_request)
+        try:
+            neuro_plugin_id = ntf.get_plugin_id({"name": "pl-neurofiles-pull"})
+        except Exception as ex:
+            return [{"status": "Failed", "error": str(ex)} for _ in l_request]
+
+        d_group = {}
+        for idx, (neuro_location, feed_name, filter_str, job_params) in enumerate(l_request):
+            d_group.setdefault((neuro_location, filter_str), []).append(idx)
+        LOG(f"Pulling {len(l_request)} jobs from the neuro tree in {len(d_group)} pulls")
+
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+
+            async def pull_and_anonymize(neuro_location: str, filter_str: str, l_idx: list[int]):
+                feed_name = l_request[l_idx[0]][1]
+                try:
+                    neuro_inst_id = await loop.run_in_executor(
+                        executor, ntf.create_plugin_instance, neuro_plugin_id,
+                        {"path": neuro_location, "include": filter_str, "title": feed_name})
+                except Exception as ex:
+                    for idx in l_idx:
+                        l_ret[idx] = {"status": "Failed", "error": str(ex)}
+                    return
+                LOG(f"Created new analysis: {feed_name}")
+                l_status = await pipe.run_pipelines(
+                    NEURO_PIPELINE,
+                    [(neuro_inst_id, self._neuro_params(l_request[idx][3])) for idx in l_idx],
+                    max_workers)
+                for idx, d_ret in zip(l_idx, l_status):
+                    l_ret[idx] = d_ret
+
+            await asyncio.gather(*(pull_and_anonymize(neuro_location, filter_str, l_idx)
+                                   for (neuro_location, filter_str), l_idx in d_group.items()))
+        return l_ret
+
+    async def run_neuro_pipeline(self, previous_inst: int, job_params: dict):
+        """
+        Run the anonymization, niftii conversion and push pipeline
+        on top of a plugin instance holding the job's DICOMs
+        """
+        pipe = Pipeline(self.api_base, self.auth, context=self.context)
+        d_ret = await pipe.run_pipeline(
+            previous_inst=previous_inst,
+            pipeline_name=NEURO_PIPELINE,
+            pipeline_params=self._neuro_params(job_params))
+        return d_ret
+
+    def _neuro_params(self, job_params: dict) -> dict:
+        """
+        Build the plugin parameters of the neuro anonymization pipeline for a job
+        """
+        send_params = job_params["push"]
+        return {
             'PACS-query': {
                 "PACSurl": job_params["pull"]["url"],
                 "PACSname": job_params["pull"]["pacs"],
-                "PACSdirective": json.dumps(job_params["search"])
+                "PACSdirective": json.dumps(dict(job_params["search"]))
             },
             'send-dicoms-to-neuro-FS': {
                 "path": f"{send_params['Dicom path']}/{send_params['Folder name']}/",
@@ -136,11 +290,6 @@ class ChrisClient(BaseClient):
                 "recipients": job_params["notify"]["recipients"]
             }
         }
-        d_ret = await pipe.run_pipeline(
-            previous_inst=neuro_inst_id,
-            pipeline_name="DICOM anonymization, niftii conversion, and push to neuro tree v20250326",
-            pipeline_params=plugin_params)
-        return d_ret
 
 
 def run_neuro_plugin(self, params: dict):
@@ -0,0 +1,44 @@
+import threading
+import concurrent.futures
+
+
+class Coalescer:
+    """
+    Memoize lookups by key and share in-flight calls between threads:
+    concurrent callers asking for the same key wait for the first caller's
+    request instead of issuing their own. Failures are not cached.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {}
+        self.inflight = {}
+
+    def get(self, key, fetch):
+        with self.lock:
+            if key in self.results:
+                return self.results[key]
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = concurrent.futures.Future()
+        if not owner:
+            return future.result()
+
+        try:
+            value = fetch()
+        except Exception as ex:
+            with self.lock:
+                del self.inflight[key]
+            future.set_exception(ex)
+            raise
+        with self.lock:
+            self.results[key] = value
+            del self.inflight[key]
+        future.set_result(value)
+        return value
+
+
+# Plugin instance -> feed and feed -> details lookups shared by
+# the Pipeline and Notification clients of a run
+FEED_LOOKUPS = Coalescer()
@@ -0,0 +1,79 @@
+import threading
+import requests
+from coalesce import Coalescer
+from limiter import AdaptiveLimiter
+from transport import TransportAdapter
+from backpressure import BackpressureGate
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class RunContext:
+    """
+    State shared by every CUBE client of a run.
+
+    Owns the HTTP session (a single connection pool carrying the auth
+    headers, optionally under an adaptive concurrency limit between the
+    ``limits`` bounds and with lookups hedged within ``hedge_budget``,
+    see ``TransportAdapter``), the coalesced lookups (feeds, plugin IDs and
+    pipeline templates), the ETags of conditional requests and the leaves
+    found finished while polling workflows, the backpressure gate of workflow submissions (with ``max_pending``),
+    the tracker polling the submitted workflows (every ``poll_interval``
+    seconds for up to ``wait_timeout`` seconds each, cancelling failed
+    ones as asked), and the PACS cache and
+    metrics store of the run, so the ``ChrisClient``, ``Pipeline`` and
+    ``Notification`` objects created per row are cheap views over it.
+    """
+
+    def __init__(self, url: str, token: str, cache=None, metrics=None, lookups: Coalescer = None,
+                 pool_size: int = 10, limits: tuple = None, max_pending: int = 0,
+                 backpressure_interval: float = 30, cancel_failed: bool = False, hedge_budget: float = 0.0,
+                 cancel_siblings: bool = False, poll_interval: float = 20, wait_timeout: float = 0):
+        self.api_base = url.rstrip('/')
+        self.token = token
+        self.headers = {"Content-Type": "application/json", "Authorization": f"Token {token}"}
+        self.session = requests.Session()
+        self.limiter = AdaptiveLimiter("cube", *limits) if limits else None
+        adapter = TransportAdapter(self.limiter, hedge_budget, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.lookups = lookups or Coalescer()
+        self.etags = {}
+        # workflow ID -> titles of its leaf plugin instances found finished
+        self.finished_leaves = {}
+        self.cache = cache
+        self.metrics = metrics
+        self.cancel_failed = cancel_failed
+        self.cancel_siblings = cancel_siblings
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        self.gate = BackpressureGate(self, max_pending, backpressure_interval) if max_pending else None
+        self.lock = threading.Lock()
+        self._tracker = None
+
+    @property
+    def tracker(self):
+        """
+        The ``WorkflowTracker`` of the workflows posted through this
+        context, created on first use
+        """
+        with self.lock:
+            if self._tracker is None:
+                from pipeline import Pipeline
+                from tracker import WorkflowTracker
+                self._tracker = WorkflowTracker(Pipeline(self.api_base, self.token, context=self),
+                                                self.cancel_failed, self.cancel_siblings, self.poll_interval,
+                                                self.wait_timeout)
+            return self._tracker
+
+    @classmethod
+    def open(cls, url: str, token: str, **kwargs) -> "RunContext":
+        """
+        Return the context of a CUBE and user, creating it on first use
+        """
+        key = (url.rstrip('/'), token)
+        with _registry_lock:
+            if key not in _registry:
+                _registry[key] = cls(url, token, **kwargs)
+            return _registry[key]
@@ -4,28 +4,22 @@ from pathlib import Path
 from argparse import ArgumentParser, Namespace, ArgumentDefaultsHelpFormatter
 from loguru import logger
 from chris_plugin import chris_plugin, PathMapper
-import pandas as pd
-from typing import List, Dict
-from chrisClient import ChrisClient
-from notification import Notification
-import pfdcm
+from typing import List, Dict, TYPE_CHECKING
+from log_config import setup_logging, register_phi
+import contextlib
 import sys
 import os
-import concurrent.futures
-import asyncio
+
+# Heavy dependencies (pandas, requests, tenacity and the CUBE/pfdcm clients)
+# are imported where they are used to keep the plugin's cold start fast.
+if TYPE_CHECKING:
+    import pandas as pd
+    from chrisClient import ChrisClient
+    from jobs import JobTable
 
 LOG = logger.debug
 
-logger_format = (
-    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> │ "
-    "<level>{level: <5}</level> │ "
-    "<yellow>{name: >28}</yellow>::"
-    "<cyan>{function: <30}</cyan> @"
-    "<cyan>{line: <4}</cyan> ║ "
-    "<level>{message}</level>"
-)
-logger.remove()
-logger.add(sys.stderr, format=logger_format)
+setup_logging()
 
 __version__ = '1.1.5'
 
@@ -52,7 +46,8 @@ parser.add_argument(
     "--pattern",
     default="**/*csv",
     help="""
-            pattern for file names to include.
+            pattern for file names to include: CSV, JSONL (.jsonl, .ndjson)
+            or Parquet (.parquet, .pq, requires pyarrow) request sheets.
             Default is **/*csv.""",
 )
 parser.add_argument(
@@ -73,7 +68,42 @@ parser.add_argument(
 parser.add_argument(
     "--maxThreads",
     default=4,
-    help="max number of parallel threads"
+    type=int,
+    help="max number of parallel threads and upper bound of the adaptive request concurrency"
+)
+parser.add_argument(
+    "--minThreads",
+    default=1,
+    type=int,
+    help="lower bound of the adaptive request concurrency (equal to --maxThreads for a fixed limit)"
+)
+parser.add_argument(
+    "--batchSize",
+    default=1,
+    type=int,
+    help="number of ready jobs whose workflows are submitted together"
+)
+parser.add_argument(
+    "--priority",
+    default="normal",
+    help="priority lane of rows without a value in a 'priority' column"
+)
+parser.add_argument(
+    "--laneWeights",
+    default="clinical:8,normal:2,research:1",
+    help="priority lanes and their weighted share of the thread budget"
+)
+parser.add_argument(
+    "--rowDeadline",
+    default=0,
+    type=float,
+    help="time budget of the CUBE lookups of a row (in seconds, 0 for none)"
+)
+parser.add_argument(
+    "--hedgeBudget",
+    default=0.0,
+    type=float,
+    help="fraction of CUBE lookups that may be hedged with a second request after the p95 latency (0 disables)"
 )
 parser.add_argument(
     "--thread",
@@ -84,11 +114,71 @@ parser.add_argument(
 )
 parser.add_argument(
     "--wait",
-    help="wait for nodes to reach finished state",
+    help="wait for all workflows to reach a terminal state and report per-row final statuses",
     dest="wait",
     action="store_true",
     default=False,
 )
+parser.add_argument(
+    "--watch",
+    help="keep running and process new sheets as they land in the input directory",
+    dest="watch",
+    action="store_true",
+    default=False,
+)
+parser.add_argument(
+    "--watchInterval",
+    default=5,
+    type=float,
+    help="interval between scans of the input directory in watch mode (in seconds)"
+)
+parser.add_argument(
+    "--watchTimeout",
+    default=0,
+    type=float,
+    help="stop watching after this many seconds without new sheets (0 watches forever)"
+)
+parser.add_argument(
+    "--cancelFailed",
+    help="cancel the queued plugin instances of failed workflows (implies --wait, so that the output "
+         "reports the cancellations)",
+    dest="cancelFailed",
+    action="store_true",
+    default=False,
+)
+parser.add_argument(
+    "--cancelSiblings",
+    help="also cancel the workflows of rows sharing the search directive of a failed workflow "
+         "(implies --cancelFailed and --wait)",
+    dest="cancelSiblings",
+    action="store_true",
+    default=False,
+)
+parser.add_argument(
+    "--pollInterval",
+    default=20,
+    type=int,
+    help="poll interval of submitted workflows (in seconds)"
+)
+parser.add_argument(
+    "--waitTimeout",
+    default=86400,
+    type=int,
+    help="in wait mode, give up the workflows still running this many seconds after their submission "
+         "and report their rows as timed out (0 waits forever)"
+)
+parser.add_argument(
+    "--maxPendingJobs",
+    default=0,
+    type=int,
+    help="hold new workflows while more plugin instances than this are queued in CUBE (0 disables)"
+)
+parser.add_argument(
+    "--backpressureInterval",
+    default=30,
+    type=float,
+    help="interval between samples of CUBE's pending jobs (in seconds)"
+)
 parser.add_argument(
     '--PFDCMurl',
     default='',
@@ -125,12 +215,138 @@ parser.add_argument(
     type=int,
     help='poll interval time for large sequences (in minutes)'
 )
+parser.add_argument(
+    '--skipUnselected',
+    help="skip rows whose first column does not say 'yes'",
+    dest='skipUnselected',
+    action='store_true',
+    default=False,
+)
+parser.add_argument(
+    '--plan',
+    help='dry run: write the request plan of the input sheets to plan.json without contacting PACS or CUBE',
+    dest='plan',
+    action='store_true',
+    default=False,
+)
+parser.add_argument(
+    '--precheck',
+    help='resolve every search directive against PACS (one status query per row not in the PACS cache) '
+         'before submitting workflows, so that rows without data fail fast; the workflows still query PACS',
+    dest='precheck',
+    action='store_true',
+    default=False,
+)
+parser.add_argument(
+    '--splitSeries',
+    help='split rows matching several series into per-series jobs (implies --precheck)',
+    dest='splitSeries',
+    action='store_true',
+    default=False,
+)
+parser.add_argument(
+    '--maxSeriesInstances',
+    default=0,
+    type=int,
+    help='only split rows matching more files than this'
+)
+parser.add_argument(
+    '--stream',
+    help='retrieve through pfdcm and start the anonymization of each series as soon as it is registered (implies --precheck)',
+    dest='stream',
+    action='store_true',
+    default=False,
+)
+parser.add_argument(
+    '--streamTimeout',
+    default=3600,
+    type=int,
+    help='give up on a streamed series without registration progress for this long (in seconds)'
+)
+parser.add_argument(
+    '--skipRegistered',
+    help='send series whose files are all registered in CUBE straight to the anonymization pipeline '
+         '(implies --precheck)',
+    dest='skipRegistered',
+    action='store_true',
+    default=False,
+)
+parser.add_argument(
+    '--cacheDir',
+    default='',
+    type=str,
+    help='directory of the persistent cache of the PACS lookups of the precheck, of directives '
+         'matching data only (disabled if empty)'
+)
+parser.add_argument(
+    '--cacheTTL',
+    default=86400,
+    type=int,
+    help='time to live of PACS cache entries (in seconds)'
+)
+parser.add_argument(
+    '--cacheSize',
+    default=64,
+    type=int,
+    help='maximum size of the PACS cache (in MB)'
+)
+parser.add_argument(
+    '--metricsDir',
+    default='',
+    type=str,
+    help='directory of the persistent store of per-row stage timings (disabled if empty)'
+)
+parser.add_argument(
+    '--logFormat',
+    default='text',
+    choices=['text', 'json'],
+    help='format of terminal.log: plain text or one JSON record per line'
+)
+parser.add_argument(
+    '--logSample',
+    default=1,
+    type=int,
+    help='after 10 repetitions, keep only every Nth debug line of the same call site'
+)
+parser.add_argument(
+    '--profile',
+    help='sample the stacks of the run and write profile.collapsed, profile.speedscope.json and profile.txt',
+    dest='profile',
+    action='store_true',
+    default=False,
+)
+parser.add_argument(
+    '--profileInterval',
+    default=5,
+    type=float,
+    help='interval between profiler samples (in milliseconds)'
+)
+parser.add_argument(
+    '--profileTop',
+    default=25,
+    type=int,
+    help='number of hot functions listed in profile.txt'
+)
+parser.add_argument(
+    '--recordTraffic',
+    help='record the CUBE and pfdcm requests of the run, with their responses and latencies, to traffic.jsonl',
+    dest='recordTraffic',
+    action='store_true',
+    default=False,
+)
+parser.add_argument(
+    '--replayTraffic',
+    default='',
+    type=str,
+    help='serve the CUBE and pfdcm responses from this traffic.jsonl instead of the network'
+)
+parser.add_argument(
+    '--replaySpeed',
+    default=1.0,
+    type=float,
+    help='speed of the replayed responses relative to the recording (0 for no delays)'
+)
 
-def skip_condition(row):
-    # Skip rows where starting column says 'no'
-    if row[0].lower() == 'yes':
-        return False
-    return True
 # The main function of this *ChRIS* plugin is denoted by this ``@chris_plugin`` "decorator."
 # Some metadata about the plugin is specified here. There is more metadata specified in setup.py.
 #
@@ -153,7 +369,6 @@ def main(options: Namespace, inputdir: Path, outputdir: Path):
     :param inputdir: directory containing (read-only) input files
     :param outputdir: directory where to write output files
     """
-
     print(DISPLAY_TITLE)
 
     # Typically it's easier to think of programs as operating on individual files
@@ -164,47 +379,166 @@ def main(options: Namespace, inputdir: Path, outputdir: Path):
     # Refer to the documentation for more options, examples, and advanced uses e.g.
     # adding a progress bar and parallelism.
     log_file = outputdir / "terminal.log"
-    logger.add(str(log_file))
+    setup_logging(str(log_file), options.logFormat, options.logSample)
 
+    with profiling(options, outputdir):
+        run_plugin(options, inputdir, outputdir)
+
+
+if __name__ == '__main__':
+    main()
+
+def run_plugin(options: Namespace, inputdir: Path, outputdir: Path):
+    """
+    Plan, or run the sheets of ``inputdir`` once or as they land
+    """
+    if options.plan:
+        write_plan(options, inputdir, outputdir)
+        return
+
+    use_traffic(options, outputdir)
     if not health_check(options): sys.exit("An error occurred!")
 
-    mapper = PathMapper.file_mapper(inputdir, outputdir, glob=options.pattern)
-    for input_file, output_file in mapper:
-
-        df = pd.read_csv(input_file, dtype=str)
-        # A custom row skipping condition can be added here to skip rows from the csv file
-        #,skiprows=lambda x: 0 if x == 0 else skip_condition(pd.read_csv(input_file, nrows=x).iloc[-1].tolist()) )
-        # 1 Remove rows with all NaN values
-        df.dropna(how='all', inplace=True)
-
-        # 2 Replace NaN values with empty strings
-        df_clean = df.fillna('')
-        l_job = create_query(df_clean)
-        d_df = []
+    context = run_context(options)
+    # cancellations are only known, and reported per row, once the workflows are waited for
+    wait = options.wait or options.cancelFailed or options.cancelSiblings
+    tracker = context.tracker if wait else None
+
+    if options.watch:
+        # Daemon mode: process sheets as they land, with a warm context.
+        # Every sheet runs in its own thread and is written once its rows
+        # are done, its jobs share the lanes and workers of one pool.
+        import threading
+        from scheduler import LanePool, LaneScheduler, parse_lane_weights
+        from watcher import SheetWatcher
+
+        pool = LanePool(LaneScheduler(parse_lane_weights(options.laneWeights)), options.maxThreads)
+        lock = threading.Lock()
         pipeline_errors = False
-        if int(options.thread):
-            with concurrent.futures.ThreadPoolExecutor(max_workers=int(options.maxThreads)) as executor:
-                results: Iterator = executor.map(lambda t: register_and_anonymize(options, t, options.wait), l_job)
 
-            # Wait for all tasks to complete
-            executor.shutdown(wait=True)
-        else:
-            for d_job in l_job:
-                response = asyncio.run(register_and_anonymize(options, d_job))
-                row = d_job["raw"]
-                row.update(d_job["push"])
-                row["status"] = response['status']
-                d_df.append(row)
-                if response.get('error'):
-                    pipeline_errors = True
-
-        # Write output CSV
-        out_csv = outputdir / input_file.name
-        pd.DataFrame(d_df).to_csv(out_csv, index=False)
+        def run_sheet(input_file: Path):
+            nonlocal pipeline_errors
+            try:
+                failed = process_sheets(options, [input_file], outputdir, context, tracker, pool)
+            except Exception as ex:
+                LOG(f"Processing {input_file.name} failed: {ex}")
+                failed = True
+            with lock:
+                pipeline_errors |= failed
+
+        l_thread = []
+        for l_input in SheetWatcher(inputdir, options.pattern, options.watchInterval, options.watchTimeout):
+            LOG(f"Processing {len(l_input)} new sheets")
+            l_thread = [thread for thread in l_thread if thread.is_alive()]
+            for input_file in l_input:
+                thread = threading.Thread(target=run_sheet, args=(input_file,), name=f"sheet-{input_file.name}")
+                thread.start()
+                l_thread.append(thread)
+        for thread in l_thread:
+            thread.join()
+        pool.shutdown()
+    else:
+        mapper = PathMapper.file_mapper(inputdir, outputdir, glob=options.pattern)
+        pipeline_errors = process_sheets(options, [input_file for input_file, _ in mapper], outputdir,
+                                         context, tracker)
+
+    # failed workflows are notified (and cancelled) by the tracker, let it finish
+    context.tracker.wait()
+
+    if pipeline_errors:
+        LOG(f"ERROR while running pipelines.")
+        sys.exit(1)
+
+
+@contextlib.contextmanager
+def profiling(options: Namespace, outputdir: Path):
+    """
+    Sample the run if ``--profile`` is set and write the profiles to
+    ``outputdir`` once it ends, even if it fails
+    """
+    if not options.profile:
+        yield
+        return
+    from profiler import SamplingProfiler
+
+    profiler = SamplingProfiler(options.profileInterval / 1000)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        profiler.write(outputdir, options.profileTop)
+        LOG(f"Profile of {profiler.samples} samples written to {outputdir}")
+
+def process_sheets(options: Namespace, l_input: List[Path], outputdir: Path, context, tracker=None,
+                   pool=None) -> bool:
+    """
+    Run the jobs of a set of sheets, on the workers of ``pool`` if given,
+    and write their output sheets, in the format of each input sheet.
+    Returns whether any row was rejected or failed.
+    """
+    from chrisClient import PIPELINE_STAGES
+    from notification import Notification
+    from sheets import SheetWriter
+    from tracker import SUMMARY_FIELDS
+
+    l_sheet = [(input_file, *load_sheet(options, input_file, outputdir, context.cache)) for input_file in l_input]
+
+    # Dispatch the jobs of all sheets together, by priority lane
+    dispatch_jobs(options, [l_job for _, l_job, _, _, _ in l_sheet], pool)
+    for _, l_job, _, _, _ in l_sheet:
+        run_neuro_stage(options, l_job)
+
+    # Write every row as soon as its workflows are done, with its number
+    # in the input sheet (data rows counted from 1) as rows complete out of order
+    l_column = ["input_row", "status", "sub_jobs", "workflow_id", "submit_s"]
+    if tracker:
+        l_column += [*SUMMARY_FIELDS, *(f"{stage}_s" for stage in PIPELINE_STAGES.values())]
+    d_writer = {input_file: SheetWriter(outputdir / input_file.name, [*l_job.df.columns, *l_column])
+                for input_file, l_job, _, _, _ in l_sheet}
+    l_pending = [(input_file, l_job, d_row, l_part)
+                 for input_file, l_job, _, _, _ in l_sheet for d_row, l_part in l_job.rows()]
+    # rejected rows only fail the run of a sheet without any valid row
+    pipeline_errors = any(not df_rejected.empty and not len(l_job) for _, l_job, df_rejected, _, _ in l_sheet)
+
+    # Rejected, duplicate and skipped rows are kept in the output, flagged
+    def write_flagged(input_file: Path, df: 'pd.DataFrame', status):
+        for index, d_row in zip(df.index, df.to_dict("records")):
+            d_writer[input_file].write({**d_row, "input_row": index + 1, "status": status(d_row)})
+
+    for input_file, _, df_rejected, df_duplicate, df_skipped in l_sheet:
+        write_flagged(input_file, df_rejected, lambda d_row: f"Rejected: {d_row['reason']}")
+        write_flagged(input_file, df_duplicate, lambda d_row: f"Duplicate of row {d_row['duplicate_of']}")
+        write_flagged(input_file, df_skipped, lambda d_row: "Skipped")
+
+    def write_rows():
+        nonlocal l_pending, pipeline_errors
+        running = set(tracker.pending()) if tracker else set()
+        l_waiting = []
+        for input_file, l_job, d_row, l_part in l_pending:
+            if any(workflow_id in running for d_job in l_part
+                   for workflow_id, _ in d_job["response"].get("workflows", [])):
+                l_waiting.append((input_file, l_job, d_row, l_part))
+                continue
+            d_result, failed = row_result(l_part, tracker)
+            pipeline_errors |= failed
+            d_writer[input_file].write({**d_row["raw"], "input_row": l_job.df.index[d_row.index] + 1, **d_result})
+        l_pending = l_waiting
+
+    if tracker:
+        write_rows()
+        tracker.wait([workflow_id for _, l_job, _, _, _ in l_sheet for d_job in l_job
+                      for workflow_id, _ in d_job["response"].get("workflows", [])], on_poll=write_rows)
+    write_rows()
+
+    for input_file, l_job, _, _, _ in l_sheet:
+        d_writer[input_file].close()
+        if context.metrics:
+            record_metrics(options, context.metrics, input_file, l_job, tracker)
 
         LOG(f"Sending notification to user(s)")
         try:
-            notification = Notification(options.CUBEurl, options.CUBEtoken)
+            notification = Notification(options.CUBEurl, options.CUBEtoken, context=context)
             notification.run_notification_plugin(pv_id=options.pluginInstanceID,
                                                  msg="Pipeline finished running",
                                                  rcpts=options.recipients,
@@ -212,65 +546,598 @@ def main(options: Namespace, inputdir: Path, outputdir: Path):
                                                  search_data="")
         except Exception as ex:
             LOG(f"Error occurred: {ex}")
-        if pipeline_errors:
-            LOG(f"ERROR while running pipelines.")
-            sys.exit(1)
 
+    if context.metrics:
+        record_limits(context)
+    return pipeline_errors
+
+
+def load_sheet(options: Namespace, input_file: Path, outputdir: Path,
+               cache=None) -> ('JobTable', 'pd.DataFrame', 'pd.DataFrame', 'pd.DataFrame'):
+    """
+    Read, normalize and validate a request sheet and build its job table.
+    Returns the table, the report of rejected rows, the duplicate rows,
+    which are not submitted again, and the rows skipped as not selected.
+    """
+    from sheets import read_sheet
+    from validation import validate_frame
+
+    df = read_sheet(input_file)
+    # 1 Remove rows with all NaN values
+    df.dropna(how='all', inplace=True)
+
+    # 2 Replace NaN values with empty strings
+    df_clean = df.fillna('')
+
+    # 3 Normalize the sheet and reject malformed rows up front
+    search_cols, _ = classify_columns(df_clean)
+    register_phi(value for col, key in search_cols if key == "PatientID" for value in df_clean[col])
+    df_clean, df_rejected, df_duplicate, df_skipped = validate_frame(df_clean, search_cols, options.skipUnselected)
+    if not df_rejected.empty:
+        LOG(f"Rejected {len(df_rejected)} rows of {input_file.name}")
+        df_rejected.to_csv(outputdir / f"{input_file.stem}.rejected.csv", index=False)
+    if not df_duplicate.empty:
+        LOG(f"Skipping {len(df_duplicate)} duplicate rows of {input_file.name}")
+
+    l_job = create_query(df_clean)
+    enrich_jobs(options, l_job)
+    if options.plan:
+        return l_job, df_rejected, df_duplicate, df_skipped
+    if options.precheck or options.splitSeries or options.stream or options.skipRegistered:
+        precheck_jobs(options, l_job, cache)
+    if options.splitSeries:
+        split_jobs(options, l_job)
+    if options.skipRegistered:
+        find_registered_jobs(options, l_job)
+    return l_job, df_rejected, df_duplicate, df_skipped
+
+
+def write_plan(options: Namespace, inputdir: Path, outputdir: Path):
+    """
+    Dry run: compute the request plan of every sheet from cached metadata
+    only and write it as JSON, without contacting PACS or CUBE
+    """
+    import json
+    import time
+    from planner import plan_sheet, combine_plans
+
+    start = time.perf_counter()
+    cache = open_cache(options)
+    metrics = open_metrics(options)
+    d_sheets = {}
+    mapper = PathMapper.file_mapper(inputdir, outputdir, glob=options.pattern)
+    for input_file, _ in mapper:
+        l_job, df_rejected, df_duplicate, df_skipped = load_sheet(options, input_file, outputdir, cache)
+        d_sheets[input_file.name] = plan_sheet(l_job, df_rejected, df_duplicate, df_skipped, options.PACSname,
+                                               options.CUBEurl, cache, metrics)
+
+    d_plan = {
+        "total": combine_plans(d_sheets),
+        "sheets": d_sheets,
+        "planning_ms": round((time.perf_counter() - start) * 1000, 1)
+    }
+    (outputdir / "plan.json").write_text(json.dumps(d_plan, indent=2))
+    print(json.dumps(d_plan["total"], indent=2))
+
+
+def job_lane(options: Namespace, d_job: dict) -> str:
+    """
+    Priority lane of a job: its sheet's priority column, if filled,
+    otherwise the run's default priority
+    """
+    for col, value in d_job["raw"].items():
+        if str(col).strip().lower() == "priority" and value:
+            return value.strip().lower()
+    return options.priority.lower()
+
+
+def dispatch_jobs(options: Namespace, l_table: List['JobTable'], pool=None):
+    """
+    Run the jobs of all tables, on the workers of a shared ``LanePool``,
+    threaded, batched or serially, in weighted fair order across priority
+    lanes, and record each job's response
+    """
+    import asyncio
+    import concurrent.futures
+    import time
+    from scheduler import LaneScheduler, parse_lane_weights
+    from transport import deadline
+
+    def run(d_job: dict):
+        start = time.perf_counter()
+        with deadline(options.rowDeadline):
+            d_job["response"] = asyncio.run(register_and_anonymize(options, d_job))
+        if d_job["response"].get("workflows"):
+            d_job["timing"] = {"submit": time.perf_counter() - start}
+
+    scheduler = LaneScheduler(parse_lane_weights(options.laneWeights))
+    stream_scheduler = LaneScheduler(parse_lane_weights(options.laneWeights))
+    l_future = []
+    for l_job in l_table:
+        for d_job in l_job:
+            lane = job_lane(options, d_job)
+            if options.stream and is_streamable(d_job):
+                stream_scheduler.submit(lane, d_job)
+            elif pool:
+                l_future.append(pool.submit(lane, run, d_job))
+            else:
+                scheduler.submit(lane, d_job)
+
+    if pool:
+        concurrent.futures.wait(l_future)
+    elif options.thread:
+        scheduler.run(run, options.maxThreads)
+    elif options.batchSize > 1:
+        l_job = scheduler.drain()
+        for d_job, response in zip(l_job, asyncio.run(register_and_anonymize_batch(options, l_job))):
+            d_job["response"] = response
+    else:
+        for d_job in scheduler.drain():
+            run(d_job)
+
+    if options.stream:
+        run_stream_stage(options, stream_scheduler.drain())
+
+    # jobs that crashed in a worker
+    for l_job in l_table:
+        for d_job in l_job:
+            d_job.setdefault("response", {"status": "Failed", "error": "Job did not run"})
 
-if __name__ == '__main__':
-    main()
 
 async def register_and_anonymize(
     options: Namespace,
-    d_job: dict,
-    wait: bool = False
+    d_job: dict
 ):
     """
     Run PACS query pipeline using the job dictionary
     """
+    from chrisClient import ChrisClient
 
-    # Enrich job (non-destructive if already present)
-    d_job.setdefault("pull", {
-        "url": options.PFDCMurl,
-        "pacs": options.PACSname
-    })
-    d_job.setdefault("notify", {
-        "recipients": options.recipients,
-        "smtp_server": options.SMTPServer
-    })
-    d_job.setdefault("relay", {
-        "largeSequenceSize": options.largeSequenceSize,
-        "largeSequencePollInterval": options.largeSequencePollInterval
-    })
-
-    LOG(d_job)
+    LOG("Running job of row {row}", row=d_job.index)
 
     # If already pushed, nothing to do
     if d_job["push"].get("status"):
         return d_job["push"]
 
-    cube_con = ChrisClient(options.CUBEurl, options.CUBEtoken)
+    # Nothing to retrieve from PACS
+    if d_job.get("resolved", {}).get("file_count") == 0:
+        return no_data_status(d_job)
 
-    # Run pipeline
-    d_ret = await cube_con.anonymize(d_job, options.pluginInstanceID)
+    cube_con = ChrisClient(options.CUBEurl, options.CUBEtoken, context=run_context(options))
 
-    # Optional neuro pull
-    search = d_job.get("search", {})
-    neuro = search.get("neuro")
+    # Run pipeline, skipping the PACS retrieve of registered series
+    if d_job.get("registered"):
+        d_ret = await registered_pull(cube_con, d_job)
+    else:
+        d_ret = await cube_con.anonymize(d_job, options.pluginInstanceID)
 
-    if neuro:
-        filter_str: str = f"*{search['PatientID']}*/*{search['StudyDate']}*/*{search['sequence']}*/**"
-        feed_name: str = f"{search['PatientID']}_{search['StudyDate']}_{search['sequence']}"
-        d_ret = await cube_con.neuro_pull(
-            neuro,
-            feed_name,
-            filter_str,
-            d_job
-        )
+    d_ret["workflows"] = job_workflows(d_ret)
+    return d_ret
+
+
+async def register_and_anonymize_batch(
+    options: Namespace,
+    l_job: List[Dict]
+) -> List[Dict]:
+    """
+    Run PACS query pipelines for a list of jobs, submitting the workflows
+    of up to ``options.batchSize`` ready jobs concurrently. Results are
+    returned in the order of ``l_job``.
+    """
+    import time
+    from chrisClient import ChrisClient
+    from transport import deadline
+
+    l_ret: List[Dict] = [{}] * len(l_job)
+    l_ready: List[int] = []
+    for idx, d_job in enumerate(l_job):
+        # If already pushed, nothing to do
+        if d_job["push"].get("status"):
+            l_ret[idx] = d_job["push"]
+        elif d_job.get("resolved", {}).get("file_count") == 0:
+            l_ret[idx] = no_data_status(d_job)
+        else:
+            l_ready.append(idx)
+
+    cube_con = ChrisClient(options.CUBEurl, options.CUBEtoken, context=run_context(options))
+    for idx in [idx for idx in l_ready if l_job[idx].get("registered")]:
+        start = time.perf_counter()
+        with deadline(options.rowDeadline):
+            l_ret[idx] = await registered_pull(cube_con, l_job[idx])
+        l_ret[idx]["workflows"] = job_workflows(l_ret[idx])
+        l_job[idx]["timing"] = {"submit": time.perf_counter() - start}
+    l_ready = [idx for idx in l_ready if not l_job[idx].get("registered")]
+    for offset in range(0, len(l_ready), options.batchSize):
+        l_batch = l_ready[offset:offset + options.batchSize]
+        LOG(f"Submitting workflows for {len(l_batch)} jobs")
+        start = time.perf_counter()
+        with deadline(options.rowDeadline):
+            l_resp = await cube_con.anonymize_batch([l_job[idx] for idx in l_batch],
+                                                    options.pluginInstanceID,
+                                                    max_workers=options.maxThreads)
+        # jobs of a batch are submitted together and share its latency
+        elapsed = time.perf_counter() - start
+        for idx, d_ret in zip(l_batch, l_resp):
+            d_ret["workflows"] = job_workflows(d_ret)
+            l_ret[idx] = d_ret
+            l_job[idx]["timing"] = {"submit": elapsed}
+
+    return l_ret
+
+
+def is_streamable(d_job: dict) -> bool:
+    """
+    Whether the series of a pending job are known, so that its retrieve
+    can be streamed series by series
+    """
+    d_resolved = d_job.get("resolved", {})
+    return (not d_job["push"].get("status") and not d_job.get("registered")
+            and d_resolved.get("file_count", 0) > 0 and bool(d_resolved.get("series")))
+
+
+def run_stream_stage(options: Namespace, l_job: List[dict]):
+    """
+    Request the PACS retrieve of every job from pfdcm, then submit the
+    anonymization pipeline of each series as soon as all of its files are
+    registered in CUBE, overlapping the retrieve of a study's remaining
+    series with the processing of its first ones
+    """
+    import asyncio
+    import pfdcm
+    from chrisClient import ChrisClient
+    from jobs import SubJob
+    from streamer import SeriesStreamer
 
+    if not l_job:
+        return
+    cube_con = ChrisClient(options.CUBEurl, options.CUBEtoken, context=run_context(options))
+    streamer = SeriesStreamer(cube_con, options.pollInterval, options.streamTimeout, options.maxThreads)
+    for d_job in l_job:
+        if pfdcm.register_pacsfiles(dict(d_job["search"]), options.PFDCMurl, options.PACSname):
+            streamer.add(d_job)
+        else:
+            d_job["response"] = {"status": "Failed", "error": "PACS retrieve request failed"}
+
+    def submit(d_job, series: dict, part: int, folder_path: str) -> dict:
+        sub_job = SubJob(d_job, series, part)
+        sub_job["registered"] = [folder_path]
+        d_ret = asyncio.run(registered_pull(cube_con, sub_job))
+        d_ret["workflows"] = job_workflows(d_ret)
+        return d_ret
+
+    for d_job, l_ret in streamer.run(submit).items():
+        d_job["response"] = merge_responses(l_ret)
+        d_job["response"].setdefault("workflows", [])
+
+
+def run_neuro_stage(options: Namespace, l_job: 'JobTable'):
+    """
+    Pull the data of all submitted jobs that request it from the neuro tree,
+    as one concurrent stage, and chain the anonymization workflows
+    """
+    import asyncio
+    from chrisClient import ChrisClient
+
+    # the neuro tree is pulled once per row, by the first part of a split row
+    l_neuro_job = [d_job for d_job in l_job
+                   if d_job["search"].get("neuro") and d_job.part == 0 and "workflows" in d_job["response"]]
+    if not l_neuro_job:
+        return
+
+    l_request = [(d_job["search"]["neuro"], feed_name, filter_str, d_job)
+                 for d_job, (feed_name, filter_str) in zip(l_neuro_job,
+                                                           neuro_filters([d_job["search"] for d_job in l_neuro_job]))]
+
+    cube_con = ChrisClient(options.CUBEurl, options.CUBEtoken, context=run_context(options))
+    l_neuro = asyncio.run(cube_con.neuro_pull_batch(l_request, max_workers=options.maxThreads))
+
+    for d_job, d_ret in zip(l_neuro_job, l_neuro):
+        d_ret["workflows"] = d_job["response"]["workflows"] + job_workflows(d_ret)
+        d_job["response"] = d_ret
+
+
+def neuro_filters(l_search: List[dict]) -> List[tuple]:
+    """
+    The (feed name, include filter) of the neuro tree pull of each search.
+    Searches of the same study share one pull: when they ask for several
+    sequences, the whole study is pulled and each row's pipeline keeps its
+    own series through its PACS directive.
+    """
+    d_sequence = {}
+    for search in l_search:
+        d_sequence.setdefault((search["neuro"], search["PatientID"], search["StudyDate"]), set()).add(search["sequence"])
+
+    l_filter = []
+    for search in l_search:
+        study = f"*{search['PatientID']}*/*{search['StudyDate']}*"
+        if len(d_sequence[(search["neuro"], search["PatientID"], search["StudyDate"])]) > 1:
+            l_filter.append((f"{search['PatientID']}_{search['StudyDate']}", f"{study}/**"))
+        else:
+            l_filter.append((f"{search['PatientID']}_{search['StudyDate']}_{search['sequence']}",
+                             f"{study}/*{search['sequence']}*/**"))
+    return l_filter
+
+
+def merge_responses(l_response: List[dict]) -> dict:
+    """
+    The response of a row from the responses of its jobs: the first
+    failure, if any, with all errors and the workflows of every job
+    """
+    if not l_response:
+        return {"status": "Failed", "error": "No job ran", "workflows": []}
+    if len(l_response) == 1:
+        return l_response[0]
+    l_failed = [response for response in l_response if response.get("error")]
+    d_ret = dict(l_failed[0] if l_failed else l_response[0])
+    if l_failed:
+        d_ret["error"] = "; ".join(str(response["error"]) for response in l_failed)
+    d_ret["workflows"] = [workflow for response in l_response for workflow in response.get("workflows", [])]
     return d_ret
 
 
+def row_result(l_part: List[dict], tracker=None) -> (dict, bool):
+    """
+    The result fields of a row from the jobs run for it: its status,
+    workflow IDs and the seconds spent in each stage, and in wait mode the
+    outcome of its workflows. Returns them with whether the row failed.
+    """
+    from chrisClient import PIPELINE_STAGES
+
+    response = merge_responses([d_job["response"] for d_job in l_part])
+    l_workflow_id = [workflow_id for workflow_id, _ in response.get("workflows", [])]
+    d_result = {"status": response["status"], "workflow_id": ",".join(map(str, l_workflow_id))}
+    if len(l_part) > 1:
+        d_result["sub_jobs"] = len(l_part)
+    l_timing = [(stage, duration) for d_job in l_part for stage, duration in d_job.get("timing", {}).items()]
+    failed = bool(response.get("error"))
+    if tracker and l_workflow_id:
+        d_result.update(tracker.summary(l_workflow_id))
+        l_timing += [(PIPELINE_STAGES.get(pipeline_name, pipeline_name), duration)
+                     for pipeline_name, _, duration in tracker.durations(l_workflow_id)]
+        failed |= d_result["status"] != "finished"
+    for stage, duration in l_timing:
+        d_result[f"{stage}_s"] = round(d_result.get(f"{stage}_s", 0) + duration, 3)
+    return d_result, failed
+
+
+def job_workflows(d_ret: dict) -> List[tuple]:
+    """
+    The (workflow ID, pipeline name) pairs posted for a job
+    """
+    if d_ret.get("workflow_id", -1) == -1:
+        return []
+    return [(d_ret["workflow_id"], d_ret["pipeline"])]
+
+
+async def registered_pull(cube_con: 'ChrisClient', d_job: dict) -> dict:
+    """
+    Run the anonymization pipeline on series already registered in CUBE
+    """
+    search = d_job["search"]
+    feed_name: str = f"{search.get('PatientID', '')}_{search.get('StudyDate', '')}_{d_job['push'].get('Folder name', '')}"
+    return await cube_con.registered_pull(d_job["registered"], feed_name, d_job)
+
+
+def enrich_jobs(options: Namespace, l_job: 'JobTable'):
+    """
+    Enrich the jobs of a table with the settings shared by the whole run
+    """
+    l_job.shared.update({
+        "pull": {
+            "url": options.PFDCMurl,
+            "pacs": options.PACSname
+        },
+        "notify": {
+            "recipients": options.recipients,
+            "smtp_server": options.SMTPServer
+        },
+        "relay": {
+            "largeSequenceSize": options.largeSequenceSize,
+            "largeSequencePollInterval": options.largeSequencePollInterval
+        }
+    })
+
+
+def no_data_status(d_job: dict) -> dict:
+    """
+    Status of a job whose directive matches no files in PACS
+    """
+    return {"status": "No data in PACS", "error": f"No PACS files match {d_job['search']}"}
+
+
+def open_cache(options: Namespace):
+    """
+    Open the persistent PACS cache, if a cache directory was given.
+    The cache is opened once per directory and shared by the whole run.
+    """
+    from pacs_cache import PACSCache
+
+    if not options.cacheDir:
+        return None
+    return PACSCache.open(options.cacheDir, ttl=options.cacheTTL, max_bytes=options.cacheSize * 1024 * 1024)
+
+
+def open_metrics(options: Namespace):
+    """
+    Open the persistent metrics store, if a metrics directory was given
+    """
+    from metrics import MetricsStore
+
+    if not options.metricsDir:
+        return None
+    return MetricsStore.open(options.metricsDir)
+
+
+def use_traffic(options: Namespace, outputdir: Path):
+    """
+    Record the HTTP traffic of the run to traffic.jsonl, or replay a recording
+    """
+    if not (options.recordTraffic or options.replayTraffic):
+        return
+    import transport
+    from traffic import TrafficRecorder, TrafficReplayer
+
+    if options.replayTraffic:
+        transport.use_traffic(TrafficReplayer(options.replayTraffic, options.replaySpeed))
+    else:
+        transport.use_traffic(TrafficRecorder(outputdir / "traffic.jsonl"))
+
+
+def run_context(options: Namespace):
+    """
+    The CUBE client context of the run: one connection pool, auth and
+    the lookup caches shared by every ChrisClient, Pipeline and Notification
+    """
+    from context import RunContext
+    import pfdcm
+
+    # start halfway and let the limiters find the highest healthy concurrency
+    limits = (options.minThreads, options.maxThreads, max(options.minThreads, options.maxThreads // 2))
+    pfdcm.use_limiter(*limits)
+    return RunContext.open(options.CUBEurl, options.CUBEtoken, cache=open_cache(options),
+                           metrics=open_metrics(options), pool_size=max(10, options.maxThreads),
+                           limits=limits, max_pending=options.maxPendingJobs,
+                           backpressure_interval=options.backpressureInterval,
+                           cancel_failed=options.cancelFailed or options.cancelSiblings,
+                           hedge_budget=options.hedgeBudget, cancel_siblings=options.cancelSiblings,
+                           poll_interval=options.pollInterval, wait_timeout=options.waitTimeout)
+
+
+def record_metrics(options: Namespace, metrics, input_file: Path, l_job: 'JobTable', tracker=None):
+    """
+    Append the stage timings of the submitted jobs of a sheet to the
+    metrics store: the submission latency, and in wait mode the run time
+    of every completed workflow
+    """
+    from chrisClient import PIPELINE_STAGES
+
+    l_record = []
+    for d_job in l_job:
+        if "timing" not in d_job:
+            continue
+        d_row = {
+            "sheet": input_file.name,
+            "pacs": options.PACSname,
+            "modality": d_job["search"].get("Modality"),
+            "instances": d_job.get("resolved", {}).get("file_count")
+        }
+        response = d_job["response"]
+        for stage, duration in d_job["timing"].items():
+            l_record.append({**d_row, "stage": stage, "duration_s": duration,
+                             "status": "failed" if response.get("error") else "finished"})
+        if tracker:
+            l_workflow_id = [workflow_id for workflow_id, _ in response.get("workflows", [])]
+            for pipeline_name, state, duration in tracker.durations(l_workflow_id):
+                l_record.append({**d_row, "stage": PIPELINE_STAGES.get(pipeline_name, pipeline_name),
+                                 "duration_s": duration, "status": state})
+    if l_record:
+        metrics.record(l_record)
+        LOG(f"Recorded {len(l_record)} stage timings of {input_file.name}")
+
+
+def record_limits(context):
+    """
+    Append the concurrency decisions of the adaptive limiters to the metrics store
+    """
+    import pfdcm
+
+    l_decision = []
+    for limiter in (context.limiter, pfdcm.limiter):
+        if limiter:
+            l_decision.extend(limiter.drain_decisions())
+    if l_decision:
+        context.metrics.record_decisions(l_decision)
+
+
+def precheck_jobs(options: Namespace, l_job: 'JobTable', cache=None):
+    """
+    Resolve the search directive of every pending job against PACS
+    (or the PACS cache) and record the autocompleted directive and
+    the number of matching files on the job.
+    """
+    import concurrent.futures
+    import pfdcm
+
+    def resolve(d_job: dict):
+        if d_job["push"].get("status"):
+            return
+        try:
+            d_job["resolved"] = pfdcm.resolve_directive(dict(d_job["search"]), options.PFDCMurl,
+                                                        options.PACSname, cache)
+        except Exception as ex:
+            LOG(f"Could not resolve {d_job['search']}: {ex}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options.maxThreads) as executor:
+        list(executor.map(resolve, l_job))
+
+
+def split_jobs(options: Namespace, l_job: 'JobTable'):
+    """
+    Split the pending rows matching several series and more than
+    ``--maxSeriesInstances`` files into one sub-job per series, so that
+    one large study is retrieved by several workflows in parallel
+    """
+    n_split = 0
+    for d_job in list(l_job.jobs):
+        d_resolved = d_job.get("resolved", {})
+        if (not d_job["push"].get("status") and len(d_resolved.get("series", [])) > 1
+                and d_resolved["file_count"] > options.maxSeriesInstances):
+            l_job.split(d_job, d_resolved["series"])
+            n_split += 1
+    if n_split:
+        LOG(f"Split {n_split} rows into per-series jobs")
+
+
+def job_series(d_job: dict) -> List[str]:
+    """
+    SeriesInstanceUIDs a job is known to match, either resolved
+    during precheck or given directly in the search directive
+    """
+    l_series = [series["SeriesInstanceUID"] for series in d_job.get("resolved", {}).get("series", [])]
+    if not l_series and d_job["search"].get("SeriesInstanceUID"):
+        l_series = [d_job["search"]["SeriesInstanceUID"]]
+    return l_series
+
+
+def find_registered_jobs(options: Namespace, l_job: 'JobTable'):
+    """
+    Bulk query CUBE's PACS series index for the series of all pending jobs
+    and mark the jobs whose series are all registered already, with as
+    many files as PACS reported, with the CUBE folder paths holding them.
+    """
+    from chrisClient import ChrisClient
+
+    l_pending = [d_job for d_job in l_job if not d_job["push"].get("status") and job_series(d_job)]
+    l_filter = []
+    for d_job in l_pending:
+        if d_job["search"].get("PatientID"):
+            d_filter = {"PatientID": d_job["search"]["PatientID"]}
+            if d_filter not in l_filter:
+                l_filter.append(d_filter)
+        else:
+            l_filter.extend({"SeriesInstanceUID": uid} for uid in job_series(d_job))
+    if not l_filter:
+        return
+
+    try:
+        cube_con = ChrisClient(options.CUBEurl, options.CUBEtoken, context=run_context(options))
+        d_registered = cube_con.get_registered_series(l_filter, max_workers=options.maxThreads)
+        l_candidate = [d_job for d_job in l_pending if all(d_registered.get(uid) for uid in job_series(d_job))]
+        l_uid = list(dict.fromkeys(uid for d_job in l_candidate for uid in job_series(d_job)))
+        d_progress = cube_con.get_series_progress(l_uid, options.maxThreads) if l_uid else {}
+    except Exception as ex:
+        LOG(f"Could not query registered series: {ex}")
+        return
+
+    for d_job in l_candidate:
+        # a series only partly registered (e.g. an interrupted retrieve) is pulled again
+        d_file_count = {series["SeriesInstanceUID"]: series.get("file_count")
+                        for series in d_job.get("resolved", {}).get("series", [])}
+        if all(d_file_count.get(uid) and d_progress.get(uid, (0, ""))[0] >= d_file_count[uid]
+               for uid in job_series(d_job)):
+            d_job["registered"] = [d_registered[uid] for uid in job_series(d_job)]
+    LOG(f"{sum(1 for d_job in l_candidate if d_job.get('registered'))} jobs already registered in CUBE")
+
 
 def _get_or_env(value, env_key):
     return value or os.environ[env_key]
@@ -280,6 +1147,9 @@ def health_check(options) -> bool:
     """
     Check if connections to PFDCM and CUBE are valid
     """
+    from chrisClient import ChrisClient
+    import pfdcm
+
     try:
         # Resolve required options from env if missing
         options.pluginInstanceID = _get_or_env(
@@ -290,7 +1160,7 @@ def health_check(options) -> bool:
         )
 
         # CUBE health check
-        cube_con = ChrisClient(options.CUBEurl, options.CUBEtoken)
+        cube_con = ChrisClient(options.CUBEurl, options.CUBEtoken, context=run_context(options))
         cube_con.health_check()
 
         # PFDCM health check
@@ -304,18 +1174,15 @@ def health_check(options) -> bool:
 
 
 
-def create_query(df: pd.DataFrame) -> List[Dict]:
+def classify_columns(df: 'pd.DataFrame') -> (List[tuple], List[str]):
     """
-    Efficiently serializes the data table to create a job dictionary
+    Classify the columns of a data table into search columns
+    (with their search keys) and anonymization/push columns
     """
-
-    columns = list(df.columns)
-
-    # Precompute column classifications
     search_cols = []
     anon_cols = []
 
-    for col in columns:
+    for col in df.columns:
         col_lower = str(col).lower()
         if any(x in col_lower for x in ("search", "neuro", "sequence")):
             # Precompute the transformed key once
@@ -325,33 +1192,16 @@ def create_query(df: pd.DataFrame) -> List[Dict]:
         if any(x in col_lower for x in ("status", "folder", "path")):
             anon_cols.append(col)
 
-    jobs = []
+    return search_cols, anon_cols
 
-    for row in df.itertuples(index=False, name=None):
-        row_dict = dict(zip(columns, row))
-
-        # Search
-        search = {
-            key: row_dict[col]
-            for col, key in search_cols
-        }
-
-        # Push / Anonymization
-        push = {
-            col: row_dict[col]
-            for col in anon_cols
-        }
-
-        # Raw
-        raw = dict(row_dict.items())
-
-        jobs.append({
-            "search": search,
-            "push": push,
-            "raw": raw
-        })
-
-    return jobs
 
+def create_query(df: 'pd.DataFrame') -> 'JobTable':
+    """
+    Efficiently serializes the data table to create a columnar job table
+    """
+    from jobs import JobTable
 
+    # Precompute column classifications
+    search_cols, anon_cols = classify_columns(df)
 
+    return JobTable(df, search_cols, anon_cols)
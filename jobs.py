@@ -0,0 +1,148 @@
+from collections.abc import Mapping
+from typing import Iterator
+import pandas as pd
+
+
+class RowView(Mapping):
+    """
+    A read-only mapping over a subset of columns of one row of a `JobTable`
+    """
+    __slots__ = ("table", "index", "columns")
+
+    def __init__(self, table: "JobTable", index: int, columns: dict):
+        self.table = table
+        self.index = index
+        self.columns = columns
+
+    def __getitem__(self, key):
+        return self.table.values[self.columns[key]][self.index]
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class Job:
+    """
+    A lightweight job record referencing one row of a `JobTable`.
+
+    Supports the mapping style access used across the clients:
+    ``search``, ``push`` and ``raw`` are views into the table's columns,
+    ``pull``, ``notify`` and ``relay`` are shared by the whole run and
+    anything else is stored per job.
+    """
+    __slots__ = ("table", "index", "extra")
+
+    VIEWS = ("search", "push", "raw")
+    # position of the job among the parts of its row, see `SubJob`
+    part = 0
+
+    def __init__(self, table: "JobTable", index: int):
+        self.table = table
+        self.index = index
+        self.extra = None
+
+    def __getitem__(self, key: str):
+        if key in self.VIEWS:
+            return RowView(self.table, self.index, self.table.views[key])
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        return self.table.shared[key]
+
+    def __setitem__(self, key: str, value):
+        if self.extra is None:
+            self.extra = {}
+        self.extra[key] = value
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.VIEWS or (self.extra is not None and key in self.extra) or key in self.table.shared
+
+    def get(self, key: str, default=None):
+        return self[key] if key in self else default
+
+    def setdefault(self, key: str, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def __repr__(self):
+        return f"Job(row={self.index}, search={self['search']!r}, push={self['push']!r})"
+
+
+class SubJob(Job):
+    """
+    A part of a row's job restricted to one of the series the row matches:
+    its search directive is the row's narrowed to the series, its resolved
+    series and file count are the series', anything else is the row's.
+    """
+    __slots__ = ("search", "part")
+
+    def __init__(self, parent: Job, series: dict, part: int):
+        super().__init__(parent.table, parent.index)
+        self.search = {**dict(parent["search"]), "SeriesInstanceUID": series["SeriesInstanceUID"]}
+        self.part = part
+        self.extra = {"resolved": {
+            "directive": {**parent["resolved"]["directive"], "SeriesInstanceUID": series["SeriesInstanceUID"]},
+            "file_count": series["file_count"],
+            "series": [series]
+        }}
+
+    def __getitem__(self, key: str):
+        if key == "search":
+            return self.search
+        return super().__getitem__(key)
+
+    def __repr__(self):
+        return f"SubJob(row={self.index}, part={self.part}, search={self.search!r})"
+
+
+class JobTable:
+    """
+    Columnar representation of the jobs of one request sheet.
+
+    Column arrays of the input frame are referenced (not copied), jobs
+    read their fields from them.
+
+    Iterating over the table yields the jobs to run: the row's job, or the
+    sub-jobs of a row that was split by series.
+    """
+
+    def __init__(self, df: pd.DataFrame, search_cols: list[tuple[str, str]], anon_cols: list[str]):
+        self.df = df
+        self.values = {col: df[col].to_numpy() for col in df.columns}
+        self.views = {
+            "search": {key: col for col, key in search_cols},
+            "push": {col: col for col in anon_cols},
+            "raw": {col: col for col in df.columns}
+        }
+        self.shared = {}
+        self.jobs = [Job(self, index) for index in range(len(df))]
+        self.parts = {}
+
+    def __len__(self) -> int:
+        return len(self.jobs)
+
+    def __getitem__(self, index: int) -> Job:
+        return self.jobs[index]
+
+    def __iter__(self) -> Iterator[Job]:
+        for job in self.jobs:
+            yield from self.parts.get(job.index, (job,))
+
+    def split(self, job: Job, l_series: list[dict]):
+        """
+        Replace the job of a row by one sub-job per series
+        """
+        self.parts[job.index] = [SubJob(job, series, part) for part, series in enumerate(l_series)]
+
+    def rows(self) -> Iterator[tuple[Job, list[Job]]]:
+        """
+        The job of every row with the jobs run for it
+        """
+        for job in self.jobs:
+            yield job, self.parts.get(job.index, [job])
@@ -0,0 +1,145 @@
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError, Timeout
+from loguru import logger
+
+LOG = logger.debug
+
+
+class AdaptiveLimiter:
+    """
+    Adaptive concurrency limit of the requests sent to a service (AIMD).
+
+    While requests succeed and their latency stays within ``latency_factor``
+    times the baseline latency, the limit grows by one slot per round of
+    requests that used it fully. Baselines are kept per endpoint, so slow
+    calls (e.g. status queries) are not compared with fast ones (e.g.
+    ``about/``). Timeouts, connection errors, 429/5xx
+    responses or a latency spike cut it by ``backoff``, at most once per
+    ``cooldown`` seconds. The limit stays within ``min_limit`` and
+    ``max_limit``; every change is kept as a decision for the metrics.
+    """
+
+    def __init__(self, name: str, min_limit: int = 1, max_limit: int = 16, initial: int = None,
+                 backoff: float = 0.5, latency_factor: float = 2.0, cooldown: float = 1.0):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(self.max_limit, max(self.min_limit, initial or self.min_limit)))
+        self.backoff = backoff
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.inflight = 0
+        # highest concurrency reached since the last change of the limit
+        self.peak = 0
+        # endpoint -> [latency EWMA, baseline latency]
+        self.latency = {}
+        self.last_cut = 0.0
+        self.decisions = []
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Block until a slot is free under the current limit
+        """
+        with self.cond:
+            while self.inflight >= int(self.limit):
+                self.cond.wait()
+            self.inflight += 1
+            self.peak = max(self.peak, self.inflight)
+
+    def release(self, latency: float, failure: str = None, endpoint: str = None):
+        """
+        Free a slot and adapt the limit to the outcome of a request to
+        ``endpoint``
+        """
+        with self.cond:
+            self.inflight -= 1
+            stats = self.latency.setdefault(endpoint, [latency, None])
+            stats[0] = 0.8 * stats[0] + 0.2 * latency
+            ewma, baseline = stats
+            if failure is None:
+                if baseline is None or ewma < baseline:
+                    stats[1] = ewma
+                else:
+                    # let the baseline follow a lasting change of the service slowly
+                    stats[1] += 0.01 * (ewma - baseline)
+                if ewma > self.latency_factor * stats[1]:
+                    failure = f"latency {ewma:.2f}s"
+
+            now = time.monotonic()
+            if failure and now - self.last_cut >= self.cooldown:
+                self.last_cut = now
+                self._set_limit(max(self.min_limit, self.limit * self.backoff), failure)
+            elif not failure and self.peak >= int(self.limit):
+                self._set_limit(min(self.max_limit, self.limit + 1 / self.limit), "healthy")
+            self.cond.notify_all()
+
+    def _set_limit(self, limit: float, reason: str):
+        old = int(self.limit)
+        self.limit = limit
+        if int(limit) != old:
+            self.peak = self.inflight
+            self.decisions.append({"ts": time.time(), "limiter": self.name, "old_limit": old,
+                                   "new_limit": int(limit), "reason": reason})
+            LOG(f"{self.name} concurrency {old} -> {int(limit)} ({reason})")
+
+    def drain_decisions(self) -> list[dict]:
+        """
+        The limit changes since the last call
+        """
+        with self.cond:
+            l_decision, self.decisions = self.decisions, []
+        return l_decision
+
+
+def endpoint(request) -> str:
+    """
+    The method and path of a request, with its ID segments (e.g. plugin
+    instance or workflow IDs) replaced by ``:id``
+    """
+    path = urlsplit(request.url).path
+    return f"{request.method} " + "/".join(":id" if re.match(r"\d", segment) else segment
+                                          for segment in path.split("/"))
+
+
+class LimitedAdapter(HTTPAdapter):
+    """
+    Transport adapter sending every request under an ``AdaptiveLimiter``
+    (if any) and reporting its latency and outcome back to it
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter = None, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.limiter is None:
+            return self.transmit(request, **kwargs)
+        key = endpoint(request)
+        self.limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response = self.transmit(request, **kwargs)
+        except Timeout:
+            self.limiter.release(time.perf_counter() - start, "timeout", key)
+            raise
+        except ConnectionError:
+            self.limiter.release(time.perf_counter() - start, "connection error", key)
+            raise
+        except Exception:
+            self.limiter.release(time.perf_counter() - start, endpoint=key)
+            raise
+        status = response.status_code
+        self.limiter.release(time.perf_counter() - start,
+                             f"HTTP {status}" if status == 429 or status >= 500 else None, key)
+        return response
+
+    def transmit(self, request, **kwargs):
+        """
+        Put a request on the wire
+        """
+        return super().send(request, **kwargs)
@@ -0,0 +1,88 @@
+import re
+import sys
+from collections import defaultdict
+from loguru import logger
+
+logger_format = (
+    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> │ "
+    "<level>{level: <5}</level> │ "
+    "<yellow>{name: >28}</yellow>::"
+    "<cyan>{function: <30}</cyan> @"
+    "<cyan>{line: <4}</cyan> ║ "
+    "<level>{message}</level>"
+)
+
+# Repetitions of a debug line from the same call site always logged before sampling starts
+SAMPLE_BURST = 10
+
+PATIENT_ID = re.compile(r"""(['"]?PatientID['"]?\s*[:=]\s*['"]?)([^'",}\s]+)""")
+TOKEN = re.compile(r"[A-Za-z0-9.\-]+")
+
+_configured = False
+_phi = set()
+
+
+def register_phi(values):
+    """
+    Register values (e.g. the PatientIDs of a sheet) to be masked
+    wherever they appear in log messages
+    """
+    _phi.update(value for value in map(str.strip, map(str, values)) if value)
+
+
+def mask_phi(text: str) -> str:
+    """
+    Mask the registered PHI values in a text
+    """
+    if _phi:
+        text = TOKEN.sub(lambda match: "***" if match.group() in _phi else match.group(), text)
+    return text
+
+
+def redact(text: str) -> str:
+    """
+    Mask PatientID fields and registered PHI values in a log message
+    """
+    return mask_phi(PATIENT_ID.sub(r"\1***", text))
+
+
+def _redact_record(record):
+    record["message"] = redact(record["message"])
+    if "PatientID" in record["extra"]:
+        record["extra"]["PatientID"] = "***"
+
+
+def _sampler(every: int):
+    """
+    Sink filter that keeps every ``every``-th debug line of a call site
+    once it has repeated ``SAMPLE_BURST`` times
+    """
+    counts = defaultdict(int)
+
+    def keep(record) -> bool:
+        if every <= 1 or record["level"].name != "DEBUG":
+            return True
+        key = (record["name"], record["line"])
+        counts[key] += 1
+        return counts[key] <= SAMPLE_BURST or counts[key] % every == 0
+    return keep
+
+
+def setup_logging(log_file: str = '', log_format: str = 'text', sample: int = 1):
+    """
+    Configure the loguru sinks of the plugin in a single place.
+    The first call installs a plain stderr sink; a call with a log file
+    replaces it with background (queued) sinks writing to stderr and to
+    the log file, as JSON records if ``log_format`` is ``json``.
+    PHI is redacted from every message.
+    """
+    global _configured
+    if not _configured:
+        logger.configure(patcher=_redact_record)
+        logger.remove()
+        logger.add(sys.stderr, format=logger_format)
+        _configured = True
+    if log_file:
+        logger.remove()
+        logger.add(sys.stderr, format=logger_format, enqueue=True, filter=_sampler(sample))
+        logger.add(log_file, serialize=log_format == 'json', enqueue=True, filter=_sampler(sample))
@@ -0,0 +1,125 @@
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from loguru import logger
+
+LOG = logger.debug
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class MetricsStore:
+    """
+    Persistent store of per-row stage timings (SQLite in ``metrics_dir``).
+
+    Every record holds the PACS, modality and instance count of a row
+    together with the duration and outcome of one of its stages, e.g.
+    ``submit``, ``retrieve`` or ``anonymize``. The store is append-only
+    and is queried to estimate the cost of future jobs. The decisions of
+    the adaptive concurrency limiters are kept alongside.
+    """
+
+    def __init__(self, metrics_dir: str):
+        self.path = Path(metrics_dir) / "metrics.sqlite"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS timings ("
+            " ts REAL NOT NULL,"
+            " sheet TEXT,"
+            " pacs TEXT,"
+            " modality TEXT,"
+            " instances INTEGER,"
+            " stage TEXT NOT NULL,"
+            " duration_s REAL NOT NULL,"
+            " status TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS timings_stage ON timings (stage, modality, pacs)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS decisions ("
+            " ts REAL NOT NULL,"
+            " limiter TEXT NOT NULL,"
+            " old_limit INTEGER NOT NULL,"
+            " new_limit INTEGER NOT NULL,"
+            " reason TEXT)"
+        )
+        self.conn.commit()
+
+    @classmethod
+    def open(cls, metrics_dir: str) -> "MetricsStore":
+        """
+        Return the store of ``metrics_dir``, opening it on first use
+        """
+        with _registry_lock:
+            if metrics_dir not in _registry:
+                _registry[metrics_dir] = cls(metrics_dir)
+            return _registry[metrics_dir]
+
+    def record(self, l_record: list[dict]):
+        """
+        Append timing records (dicts with the columns of the store)
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO timings (ts, sheet, pacs, modality, instances, stage, duration_s, status)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(now, d.get("sheet"), d.get("pacs"), d.get("modality"), d.get("instances"),
+                  d["stage"], d["duration_s"], d.get("status")) for d in l_record]
+            )
+            self.conn.commit()
+
+    def record_decisions(self, l_decision: list[dict]):
+        """
+        Append concurrency limit changes (see ``AdaptiveLimiter``)
+        """
+        with self.lock:
+            self.conn.executemany(
+                "INSERT INTO decisions (ts, limiter, old_limit, new_limit, reason) VALUES (?, ?, ?, ?, ?)",
+                [(d["ts"], d["limiter"], d["old_limit"], d["new_limit"], d["reason"]) for d in l_decision]
+            )
+            self.conn.commit()
+
+    def estimate(self, stage: str, pacs: str = None, modality: str = None, instances: int = None):
+        """
+        Estimate the duration (in seconds) of a stage from the finished
+        records of the same stage, PACS and modality, relaxing the modality
+        and then the PACS filter if there is no history for them. Scales
+        by instance count when both the history and the job have one.
+        Returns ``None`` without any history.
+        """
+        for d_filter in ({"pacs": pacs, "modality": modality}, {"pacs": pacs}, {}):
+            where = " AND ".join(["stage = ?", "status = 'finished'"] + [f"{col} = ?" for col in d_filter])
+            with self.lock:
+                # only the records with an instance count are used to scale
+                total_s, count, scaled_s, total_instances = self.conn.execute(
+                    "SELECT SUM(duration_s), COUNT(*), SUM(CASE WHEN instances IS NOT NULL THEN duration_s END),"
+                    f" SUM(instances) FROM timings WHERE {where}",
+                    (stage, *d_filter.values())
+                ).fetchone()
+            if not count:
+                continue
+            if instances and total_instances:
+                return scaled_s / total_instances * instances
+            return total_s / count
+        return None
+
+    def estimate_job(self, l_stage: list[str], pacs: str = None, modality: str = None, instances: int = None):
+        """
+        Estimated duration of a job going through ``l_stage``, or ``None``
+        if any stage has no history
+        """
+        total = 0.0
+        for stage in l_stage:
+            estimate = self.estimate(stage, pacs, modality, instances)
+            if estimate is None:
+                return None
+            total += estimate
+        return total
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -7,11 +7,16 @@ from loguru import logger
 import time
 import asyncio
 from urllib.parse import urlencode
+from coalesce import Coalescer, FEED_LOOKUPS
+from context import RunContext
 
 class Notification:
-    def __init__(self, url: str, token: str):
-        self.api_base = url.rstrip('/')
-        self.headers = {"Content-Type": "application/json", "Authorization": f"Token {token}"}
+    def __init__(self, url: str, token: str, lookups: Coalescer = FEED_LOOKUPS, context: RunContext = None):
+        self.context = context or RunContext(url, token, lookups=lookups)
+        self.api_base = self.context.api_base
+        self.headers = self.context.headers
+        self.lookups = self.context.lookups
+        self.session = self.context.session
 
     # --------------------------
     # Retryable request handler
@@ -24,7 +29,7 @@ class Notification:
     )
     def make_request(self, method: str, endpoint: str, **kwargs):
         url = f"{self.api_base}{endpoint}"
-        response = requests.request(method, url, headers=self.headers, timeout=30, **kwargs)
+        response = self.session.request(method, url, headers=self.headers, timeout=30, **kwargs)
         response.raise_for_status()
 
         try:
@@ -34,7 +39,7 @@ class Notification:
 
     def post_request(self, endpoint: str, **kwargs):
         url = f"{self.api_base}{endpoint}"
-        response = requests.request("POST", url, headers=self.headers, timeout=30, **kwargs)
+        response = self.session.request("POST", url, headers=self.headers, timeout=30, **kwargs)
         response.raise_for_status()
 
         try:
@@ -44,6 +49,10 @@ class Notification:
 
     def get_feed_id_from_plugin_inst(self, plugin_inst: int) -> int:
         """Get feed_id from a given plugin instance"""
+        return self.lookups.get((self.api_base, "feed_id", plugin_inst),
+                                lambda: self._fetch_feed_id_from_plugin_inst(plugin_inst))
+
+    def _fetch_feed_id_from_plugin_inst(self, plugin_inst: int) -> int:
         logger.info(f"Fetching feed id for plugin instance with ID: {plugin_inst}")
         response = self.make_request("GET",f"/plugins/instances/{plugin_inst}/")
         for item in response:
@@ -54,6 +63,10 @@ class Notification:
 
     def get_feed_details_from_id(self, feed_id: int) -> dict:
         """Get feed details given a feed id"""
+        return self.lookups.get((self.api_base, "feed_details", feed_id),
+                                lambda: self._fetch_feed_details_from_id(feed_id))
+
+    def _fetch_feed_details_from_id(self, feed_id: int) -> dict:
         feed_details = {}
 
         logger.info(f"Getting feed details for ID: {feed_id}")
@@ -120,8 +133,12 @@ class Notification:
 
     def get_plugin_id(self, params: dict):
         """
-        Fetch plugin ID by search parameters.
+        Fetch plugin ID by search parameters, once per run context.
         """
+        return self.lookups.get((self.api_base, "plugin_id", tuple(sorted(params.items()))),
+                                lambda: self._fetch_plugin_id(params))
+
+    def _fetch_plugin_id(self, params: dict):
         query_string = urlencode(params)
         response = self.make_request("GET", f"/plugins/search/?{query_string}")
 
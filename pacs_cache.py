@@ -0,0 +1,116 @@
+import json
+import sqlite3
+import threading
+import time
+import hashlib
+from pathlib import Path
+from loguru import logger
+
+LOG = logger.debug
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def normalize_directive(directive: dict) -> dict:
+    """
+    Normalize a search directive so that equivalent directives share
+    a cache entry: keys and values are stripped and empty fields dropped.
+    """
+    return {
+        str(key).strip(): str(value).strip()
+        for key, value in directive.items()
+        if str(value).strip()
+    }
+
+
+class PACSCache:
+    """
+    A small persistent cache of PACS lookups keyed by the kind of lookup,
+    the PACS name and the normalized search directive.
+
+    Entries live in a SQLite file inside ``cache_dir``, expire after ``ttl``
+    seconds and are evicted least-recently-used first once the stored
+    payloads exceed ``max_bytes``.
+    """
+
+    def __init__(self, cache_dir: str, ttl: int = 86400, max_bytes: int = 64 * 1024 * 1024):
+        self.path = Path(cache_dir) / "pacs_cache.sqlite"
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    @classmethod
+    def open(cls, cache_dir: str, **kwargs) -> "PACSCache":
+        """
+        Return the cache of ``cache_dir``, opening it on first use
+        """
+        with _registry_lock:
+            if cache_dir not in _registry:
+                _registry[cache_dir] = cls(cache_dir, **kwargs)
+            return _registry[cache_dir]
+
+    @staticmethod
+    def make_key(kind: str, pacs_name: str, directive: dict) -> str:
+        payload = json.dumps([kind, pacs_name, normalize_directive(directive)], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, kind: str, pacs_name: str, directive: dict):
+        """
+        Return the cached value or ``None`` on a miss or an expired entry.
+        """
+        key = self.make_key(kind, pacs_name, directive)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        LOG(f"PACS cache hit for {kind} lookup")
+        return json.loads(row[0])
+
+    def put(self, kind: str, pacs_name: str, directive: dict, value):
+        """
+        Store a value, then evict expired and least recently used entries.
+        """
+        key = self.make_key(kind, pacs_name, directive)
+        payload = json.dumps(value)
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now)
+            )
+            self._evict(now)
+            self.conn.commit()
+
+    def _evict(self, now: float):
+        self.conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,28 +1,36 @@
 import requests
 from loguru import logger
-import sys
 import copy
 from collections import ChainMap
 import json
 
 LOG = logger.debug
 
-logger_format = (
-    "<green>{time:YYYY-MM-DD HH:mm:ss}</green> │ "
-    "<level>{level: <5}</level> │ "
-    "<yellow>{name: >28}</yellow>::"
-    "<cyan>{function: <30}</cyan> @"
-    "<cyan>{line: <4}</cyan> ║ "
-    "<level>{message}</level>"
-)
-logger.remove()
-logger.add(sys.stderr, format=logger_format)
+# Session of all requests to pfdcm, see `use_limiter`
+session = requests.Session()
+limiter = None
+
+
+def use_limiter(min_limit: int, max_limit: int, initial: int = None):
+    """
+    Send the requests to pfdcm under an adaptive concurrency limit
+    """
+    global limiter
+    from limiter import AdaptiveLimiter
+    from transport import TransportAdapter
+
+    if limiter is None:
+        limiter = AdaptiveLimiter("pfdcm", min_limit, max_limit, initial)
+        adapter = TransportAdapter(limiter, pool_connections=max_limit, pool_maxsize=max_limit)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+    return limiter
 
 def health_check(url: str):
     pfdcm_about_api = f'{url}about/'
     headers = {'Content-Type': 'application/json', 'accept': 'application/json'}
     try:
-        response = requests.get(pfdcm_about_api, headers=headers)
+        response = session.get(pfdcm_about_api, headers=headers)
         return response
     except Exception as er:
         raise Exception("Connection to pfdcm could not be established.")
@@ -92,10 +100,10 @@ def register_pacsfiles(directive: dict, url: str, pacs_name: str):
         }
     }
     body["PACSdirective"].update(directive)
-    LOG(body)
+    LOG("Sending pfdcm {} request for {}", body["PACSdirective"]["then"], directive)
 
     try:
-        response = requests.post(pfdcm_dicom_api, json=body, headers=headers)
+        response = session.post(pfdcm_dicom_api, json=body, headers=headers)
         d_response = json.loads(response.text)
         if d_response['status']:
             return d_response
@@ -105,11 +113,17 @@ def register_pacsfiles(directive: dict, url: str, pacs_name: str):
         LOG(er)
 
 
-def get_pfdcm_status(directive: dict, url: str, pacs_name: str):
+def get_pfdcm_status(directive: dict, url: str, pacs_name: str, cache=None):
     """
     Get the status of PACS from `pfdcm`
-    by running the synchronous API of `pfdcm`
+    by running the synchronous API of `pfdcm`.
+    Responses are served from and stored into an optional `PACSCache`,
+    unless they match nothing: studies may still arrive in PACS.
     """
+    if cache:
+        d_cached = cache.get("status", pacs_name, directive)
+        if d_cached is not None:
+            return d_cached
 
     pfdcm_status_url = f'{url}PACS/sync/pypx/'
     headers = {'Content-Type': 'application/json', 'accept': 'application/json'}
@@ -130,12 +144,56 @@ def get_pfdcm_status(directive: dict, url: str, pacs_name: str):
         }
     }
     body["PACSdirective"].update(directive)
-    LOG(body)
+    LOG("Sending pfdcm {} request for {}", body["PACSdirective"]["then"], directive)
 
     try:
-        response = requests.post(pfdcm_status_url, json=body, headers=headers)
+        response = session.post(pfdcm_status_url, json=body, headers=headers)
         d_response = json.loads(response.text)
-        if d_response['status']: return d_response
-        else: raise Exception(d_response['message'])
+        if not d_response['status']: raise Exception(d_response['message'])
+        if cache and any(d_study.get("series") for d_study in d_response.get("pypx", {}).get("data", [])):
+            cache.put("status", pacs_name, directive, d_response)
+        return d_response
     except Exception as ex:
-        LOG(ex)
\ No newline at end of file
+        LOG(ex)
+
+
+def list_series(d_response: dict) -> list[dict]:
+    """
+    List the series (UIDs and instance counts) of a `pfdcm` status response
+    """
+    l_series = []
+    for l_study in d_response['pypx']['data']:
+        for series in l_study["series"]:
+            l_series.append({
+                "SeriesInstanceUID": series["SeriesInstanceUID"]["value"],
+                "StudyInstanceUID": series["StudyInstanceUID"]["value"],
+                "file_count": int(series["NumberOfSeriesRelatedInstances"]["value"])
+            })
+    return l_series
+
+
+def resolve_directive(directive: dict, url: str, pacs_name: str, cache=None) -> dict:
+    """
+    Autocomplete a search directive against PACS, count the matching
+    files and list the matching series. Results matching files are served
+    from and stored into an optional `PACSCache`, in which case resolving
+    the same directive again does not touch PACS (the PACS-query node of
+    its workflow still queries it).
+    """
+    if cache:
+        d_cached = cache.get("autocomplete", pacs_name, directive)
+        if d_cached is not None:
+            return d_cached
+
+    d_response = get_pfdcm_status(directive, url, pacs_name, cache)
+    if not d_response:
+        raise Exception(f"PACS status query failed for {directive}")
+    search_directive, file_count = autocomplete_directive(directive, d_response)
+    d_resolved = {
+        "directive": search_directive,
+        "file_count": file_count,
+        "series": list_series(d_response)
+    }
+    if cache and file_count:
+        cache.put("autocomplete", pacs_name, directive, d_resolved)
+    return d_resolved
\ No newline at end of file
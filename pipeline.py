@@ -6,7 +6,11 @@ from tenacity import retry, wait_exponential, stop_after_attempt, retry_if_excep
 from loguru import logger
 import time
 import asyncio
+import concurrent.futures
 from urllib.parse import urlencode
+from coalesce import Coalescer, FEED_LOOKUPS
+from context import RunContext
+from backpressure import PENDING_STATES
 
 
 def transform_plugin_data(nested_data_list: list[dict]) -> list[dict]:
@@ -63,10 +67,26 @@ def compute_workflow_nodes_info(pipeline_default_parameters: list[dict], include
     return nodes_info
 
 
+def workflow_leaf_titles(nodes_info: list[dict]) -> list[str]:
+    """
+    Titles of the pipings of a pipeline that no other piping follows.
+    A workflow is complete once all of its leaf plugin instances are.
+    """
+    previous_ids = {piping['previous_piping_id'] for piping in nodes_info}
+    return [piping['title'] for piping in nodes_info if piping['piping_id'] not in previous_ids]
+
+
 class Pipeline:
-    def __init__(self, url: str, token: str):
-        self.api_base = url.rstrip('/')
-        self.headers = {"Content-Type": "application/json", "Authorization": f"Token {token}"}
+    def __init__(self, url: str, token: str, lookups: Coalescer = FEED_LOOKUPS, cache=None,
+                 context: RunContext = None):
+        self.context = context or RunContext(url, token, cache=cache, lookups=lookups)
+        self.api_base = self.context.api_base
+        self.headers = self.context.headers
+        self.lookups = self.context.lookups
+        self.cache = self.context.cache
+        self.session = self.context.session
+        self.etags = self.context.etags
+        self.finished_leaves = self.context.finished_leaves
 
     # --------------------------
     # Retryable request handler
@@ -79,7 +99,7 @@ class Pipeline:
     )
     def make_request(self, method: str, endpoint: str, **kwargs):
         url = f"{self.api_base}{endpoint}"
-        response = requests.request(method, url, headers=self.headers, timeout=30, **kwargs)
+        response = self.session.request(method, url, headers=self.headers, timeout=30, **kwargs)
         response.raise_for_status()
 
         try:
@@ -87,9 +107,35 @@ class Pipeline:
         except ValueError:
             return response.text
 
+    @retry(
+        retry=retry_if_exception_type((RequestException, Timeout, HTTPError)),
+        wait=wait_exponential(multiplier=1, min=2, max=10),
+        stop=stop_after_attempt(5),
+        reraise=True
+    )
+    def conditional_request(self, endpoint: str):
+        """
+        GET a collection with ``If-None-Match`` using the ETag of the previous
+        response, so an unchanged resource costs a bodiless 304.
+        """
+        url = f"{self.api_base}{endpoint}"
+        headers = dict(self.headers)
+        etag, items = self.etags.get(endpoint, (None, None))
+        if etag:
+            headers["If-None-Match"] = etag
+        response = self.session.request("GET", url, headers=headers, timeout=30)
+        if response.status_code == 304:
+            return items
+        response.raise_for_status()
+
+        items = response.json().get("collection", {}).get("items", [])
+        if response.headers.get("ETag"):
+            self.etags[endpoint] = (response.headers["ETag"], items)
+        return items
+
     def post_request(self, endpoint: str, **kwargs):
         url = f"{self.api_base}{endpoint}"
-        response = requests.request("POST", url, headers=self.headers, timeout=30, **kwargs)
+        response = self.session.request("POST", url, headers=self.headers, timeout=30, **kwargs)
         response.raise_for_status()
 
         try:
@@ -109,7 +155,7 @@ class Pipeline:
             for field in item.get("data", []):
                 if field.get("name") == "id":
                     return field.get("value")
-        return -1
+        raise Exception(f"No workflow ID in the response of pipeline {pipeline_id}")
 
     def get_pipeline_total_pipings(self, pipeline_id: int) -> int:
         """Get the total number of plugin pipings in the given pipeline."""
@@ -125,16 +171,24 @@ class Pipeline:
 
     def get_feed_id_from_plugin_inst(self, plugin_inst: int) -> int:
         """Get feed_id from a given plugin instance"""
+        return self.lookups.get((self.api_base, "feed_id", plugin_inst),
+                                lambda: self._fetch_feed_id_from_plugin_inst(plugin_inst))
+
+    def _fetch_feed_id_from_plugin_inst(self, plugin_inst: int) -> int:
         logger.info(f"Fetching feed id for plugin instance with ID: {plugin_inst}")
         response = self.make_request("GET",f"/plugins/instances/{plugin_inst}/")
         for item in response:
             for field in item.get("data", []):
                 if field.get("name") == "feed_id":
                     return field.get("value")
-        return -1
+        raise Exception(f"No workflow ID in the response of pipeline {pipeline_id}")
 
     def get_feed_details_from_id(self, feed_id: int) -> dict:
         """Get feed details given a feed id"""
+        return self.lookups.get((self.api_base, "feed_details", feed_id),
+                                lambda: self._fetch_feed_details_from_id(feed_id))
+
+    def _fetch_feed_details_from_id(self, feed_id: int) -> dict:
         feed_details = {}
 
         logger.info(f"Getting feed details for ID: {feed_id}")
@@ -153,8 +207,13 @@ class Pipeline:
 
     def post_workflow(self, pipeline_id: int, previous_id: int, params: list[dict]) -> int:
         """
-        Trigger a pipeline workflow in CUBE.
+        Trigger a pipeline workflow in CUBE, once the backpressure gate
+        of the run (if any) lets it through. Returns the workflow ID and
+        fails if CUBE's response has none.
         """
+        gate = self.context.gate
+        if gate:
+            gate.wait()
         payload = {
             "previous_plugin_inst_id": previous_id,
             "nodes_info": json.dumps(params)
@@ -163,8 +222,58 @@ class Pipeline:
         for item in response:
             for field in item.get("data", []):
                 if field.get("name") == "id":
+                    if gate:
+                        gate.add(field.get("value"), len(params))
                     return field.get("value")
-        return -1
+        raise Exception(f"No workflow ID in the response of pipeline {pipeline_id}")
+
+    def post_workflows(self, pipeline_id: int, l_workflow: list[tuple[int, list[dict]]],
+                       max_workers: int = 4) -> list[tuple[int, float]]:
+        """
+        Trigger several pipeline workflows in CUBE concurrently.
+
+        CUBE has no bulk workflow endpoint, so the POSTs are issued in
+        parallel over the pooled session instead. The workflow IDs and
+        post times are returned in the order of ``l_workflow``; a failed
+        submission yields the ID -1.
+        """
+        def submit(workflow: tuple[int, list[dict]]) -> tuple[int, float]:
+            previous_id, params = workflow
+            try:
+                workflow_id = self.post_workflow(pipeline_id=pipeline_id, previous_id=previous_id, params=params)
+            except Exception as ex:
+                logger.error(f"Posting workflow on {previous_id} failed due to: {ex}")
+                workflow_id = -1
+            return workflow_id, time.time()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            return list(executor.map(submit, l_workflow))
+
+    def resolve_pipeline(self, pipeline_name: str) -> dict:
+        """
+        Resolve a pipeline template (ID, total pipings and default nodes info)
+        once per run context and reuse it for every subsequent workflow.
+        """
+        return self.lookups.get((self.api_base, "template", pipeline_name),
+                                lambda: self._fetch_template(pipeline_name))
+
+    def _fetch_template(self, pipeline_name: str) -> dict:
+        pipeline_id = self.get_pipeline_id(pipeline_name)
+        total_jobs = self.get_pipeline_total_pipings(pipeline_id)
+        default_params = self.get_pipeline_parameters(pipeline_id)
+        nodes_info = compute_workflow_nodes_info(default_params)
+        template = {
+            "pipeline_id": pipeline_id,
+            "total_jobs": total_jobs,
+            "default_params": default_params,
+            # pipings without parameters are missing from the defaults,
+            # fall back to full workflow polling if the tree is incomplete
+            "leaf_titles": workflow_leaf_titles(nodes_info) if len(nodes_info) == total_jobs else []
+        }
+        # remember the template for offline planning
+        if self.cache:
+            self.cache.put("pipeline", self.api_base, {"name": pipeline_name}, template)
+        return template
 
     def _get_workflow_status(self, workflow_id: int) -> dict:
         """
@@ -205,27 +314,96 @@ class Pipeline:
         return {
             "finished_jobs": finished_jobs,
             "total_jobs": finished_jobs + errored_jobs + cancelled_jobs + created_jobs + waiting_jobs + scheduled_jobs + started_jobs + registering_jobs,
-            "workflow_failed": (errored_jobs > 0 or cancelled_jobs > 0)
+            "workflow_failed": (errored_jobs > 0 or cancelled_jobs > 0),
+            "errored_jobs": errored_jobs,
+            "cancelled_jobs": cancelled_jobs,
+            "pending_jobs": created_jobs + waiting_jobs + scheduled_jobs,
+            "running_jobs": started_jobs + registering_jobs
         }
 
-    async def monitor_pipeline(self, workflow_id, total_jobs, pv_inst, rcpts, smtp, search_data):
-        try:
-            d_search_data = json.loads(search_data)
-            while True:
-                status = self._get_workflow_status(workflow_id)
-                if status["workflow_failed"]:
-                    logger.error("Pipeline failed.")
-                    self.run_notification_plugin(pv_inst, "Pipeline failed with errors", rcpts, smtp, d_search_data)
-                    break
-                if status["finished_jobs"] >= total_jobs:
-                    logger.info("Pipeline complete.")
-                    break
-                if status["total_jobs"] < total_jobs:
-                    self.run_notification_plugin(pv_inst, "Nodes deleted in pipeline", rcpts, smtp, d_search_data)
-                    break
-                time.sleep(20)
-        except Exception as e:
-            logger.exception("Monitoring pipeline failed.")
+    def cancel_workflow(self, workflow_id: int) -> list[int]:
+        """
+        Cancel the plugin instances of a workflow that have not started yet
+        and return their IDs
+        """
+        l_cancelled = []
+        response = self.make_request("GET", f"/plugins/instances/search/?{urlencode({'workflow_id': workflow_id, 'limit': 100})}")
+        for item in response:
+            d_data = {field.get("name"): field.get("value") for field in item.get("data", [])}
+            if d_data.get("status") not in PENDING_STATES:
+                continue
+            try:
+                self.make_request("PUT", f"/plugins/instances/{d_data['id']}/", json={"status": "cancelled"})
+                l_cancelled.append(d_data["id"])
+            except Exception as ex:
+                logger.error(f"Cancelling plugin instance {d_data['id']} failed: {ex}")
+        if l_cancelled:
+            logger.info(f"Cancelled {len(l_cancelled)} queued instances of failed workflow {workflow_id}")
+        return l_cancelled
+
+    def count_plugin_instances(self, l_status: tuple) -> int:
+        """
+        Number of plugin instances in the given states, or ``None`` if
+        CUBE does not report collection totals
+        """
+        total = 0
+        for status in l_status:
+            url = f"{self.api_base}/plugins/instances/search/?{urlencode({'status': status, 'limit': 1})}"
+            response = self.session.request("GET", url, headers=self.headers, timeout=30)
+            response.raise_for_status()
+            count = response.json().get("collection", {}).get("total")
+            if count is None:
+                return None
+            total += count
+        return total
+
+    @staticmethod
+    def _leaf_endpoint(workflow_id: int, title: str) -> str:
+        return f"/plugins/instances/search/?{urlencode({'workflow_id': workflow_id, 'title': title, 'limit': 10})}"
+
+    def _get_workflow_leaf_status(self, workflow_id: int, leaf_titles: list[str]) -> dict:
+        """
+        Lightweight completion check of a workflow that only looks at its
+        leaf plugin instances:
+        1. Fetch each leaf instance by workflow and title (conditionally),
+           except the leaves found finished by a previous check
+        2. Count finished leaves and leaves still present
+        3. A cancelled or errored leaf means the workflow failed, as CUBE
+           cancels all descendants of an errored instance
+        """
+        finished = self.finished_leaves.setdefault(workflow_id, set())
+        finished_jobs = present_jobs = len(finished.intersection(leaf_titles))
+        workflow_failed = False
+
+        for title in leaf_titles:
+            if title in finished:
+                continue
+            response = self.conditional_request(self._leaf_endpoint(workflow_id, title))
+            for item in response:
+                d_data = {field.get("name"): field.get("value") for field in item.get("data", [])}
+                if d_data.get("title") != title:
+                    continue
+                present_jobs += 1
+                if d_data.get("status") == "finished":
+                    finished_jobs += 1
+                    finished.add(title)
+                if d_data.get("status") in ("errored", "cancelled"):
+                    workflow_failed = True
+                break
+
+        return {
+            "finished_jobs": finished_jobs,
+            "total_jobs": present_jobs,
+            "workflow_failed": workflow_failed
+        }
+
+    def forget_workflow(self, workflow_id: int, leaf_titles: list[str]):
+        """
+        Drop the ETags and finished leaves kept to poll a workflow once it is done
+        """
+        self.finished_leaves.pop(workflow_id, None)
+        for title in leaf_titles:
+            self.etags.pop(self._leaf_endpoint(workflow_id, title), None)
 
     def run_notification_plugin(self, pv_id: int, msg: str, rcpts: str, smtp: str, search_data: str) -> int:
         """
@@ -280,8 +458,12 @@ class Pipeline:
 
     def _get_plugin_id(self, params: dict):
         """
-        Fetch plugin ID by search parameters.
+        Fetch plugin ID by search parameters, once per run context.
         """
+        return self.lookups.get((self.api_base, "plugin_id", tuple(sorted(params.items()))),
+                                lambda: self._fetch_plugin_id(params))
+
+    def _fetch_plugin_id(self, params: dict):
         query_string = urlencode(params)
         response = self.make_request("GET", f"/plugins/search/?{query_string}")
 
@@ -292,6 +474,21 @@ class Pipeline:
 
         raise RuntimeError(f"No plugin found with matching criteria: {params}")
 
+    def _track(self, workflow_id: int, pipeline_name: str, previous_inst: int, pipeline_params: dict,
+               submitted: float):
+        """
+        Hand a workflow posted at ``submitted`` over to the tracker of the
+        run, which polls it in the background and sends the failure
+        notification
+        """
+        search_data = pipeline_params["PACS-query"]["PACSdirective"]
+        notify = (previous_inst,
+                  pipeline_params["verify-registration"]["recipients"],
+                  pipeline_params["verify-registration"]["SMTPServer"],
+                  search_data)
+        group = json.dumps(json.loads(search_data), sort_keys=True)
+        self.context.tracker.add(workflow_id, pipeline_name, group, notify, submitted)
+
     async def run_pipeline(self, pipeline_name: str, previous_inst: int, pipeline_params: dict):
         """
         Full workflow to:
@@ -300,32 +497,51 @@ class Pipeline:
         3. Update them
         4. Trigger the pipeline
         """
-        smtp_server = pipeline_params["verify-registration"]["SMTPServer"]
-        recipients = pipeline_params["verify-registration"]["recipients"]
-        search_data = pipeline_params["PACS-query"]["PACSdirective"]
-        search_data = json.dumps(search_data)
         try:
-            pipeline_id = self.get_pipeline_id(pipeline_name)
-            total_jobs = self.get_pipeline_total_pipings(pipeline_id)
-            default_params = self.get_pipeline_parameters(pipeline_id)
-            nodes_info = compute_workflow_nodes_info(default_params, include_all_defaults=True)
+            template = self.resolve_pipeline(pipeline_name)
+            nodes_info = compute_workflow_nodes_info(template["default_params"], include_all_defaults=True)
             updated_params = update_plugin_parameters(nodes_info, pipeline_params)
-            workflow_id = self.post_workflow(pipeline_id=pipeline_id, previous_id=previous_inst, params=updated_params)
-
-            # Start this in the background (not awaited)
-            task = asyncio.create_task(
-                self.monitor_pipeline(workflow_id, total_jobs, previous_inst, recipients, smtp_server, search_data))
-
-            def handle_task_result(task: asyncio.Task):
-                try:
-                    task.result()  # re-raises exception if one occurred
-                except Exception:
-                    logger.exception("monitor_pipeline task failed")
-
-            task.add_done_callback(handle_task_result)
+            workflow_id = self.post_workflow(pipeline_id=template["pipeline_id"],
+                                             previous_id=previous_inst,
+                                             params=updated_params)
+            submitted = time.time()
+            self._track(workflow_id, pipeline_name, previous_inst, pipeline_params, submitted)
 
             logger.info(f"Workflow posted successfully")
-            return {"status": "Pipeline running"}
+            return {"status": "Pipeline running", "workflow_id": workflow_id, "pipeline": pipeline_name,
+                    "submitted": submitted}
         except Exception as ex:
             logger.error(f"Running pipeline failed due to: {ex}")
             return {"status": "Failed", "error": str(ex)}
+
+    async def run_pipelines(self, pipeline_name: str, l_pipeline: list[tuple[int, dict]], max_workers: int = 4) -> list[dict]:
+        """
+        Batched variant of ``run_pipeline``:
+        1. Resolve the pipeline template once
+        2. Build the nodes info of every job
+        3. Post all workflows concurrently
+        4. Return one status per job, in order
+        """
+        try:
+            template = self.resolve_pipeline(pipeline_name)
+        except Exception as ex:
+            logger.error(f"Running pipeline failed due to: {ex}")
+            return [{"status": "Failed", "error": str(ex)} for _ in l_pipeline]
+
+        l_workflow = []
+        for previous_inst, pipeline_params in l_pipeline:
+            nodes_info = compute_workflow_nodes_info(template["default_params"], include_all_defaults=True)
+            l_workflow.append((previous_inst, update_plugin_parameters(nodes_info, pipeline_params)))
+
+        l_posted = await asyncio.to_thread(self.post_workflows, template["pipeline_id"], l_workflow, max_workers)
+
+        l_ret = []
+        for (previous_inst, pipeline_params), (workflow_id, submitted) in zip(l_pipeline, l_posted):
+            if workflow_id == -1:
+                l_ret.append({"status": "Failed", "error": "Workflow could not be posted"})
+                continue
+            self._track(workflow_id, pipeline_name, previous_inst, pipeline_params, submitted)
+            l_ret.append({"status": "Pipeline running", "workflow_id": workflow_id, "pipeline": pipeline_name,
+                          "submitted": submitted})
+        logger.info(f"Posted {len(l_posted)} workflows of {pipeline_name}")
+        return l_ret
@@ -0,0 +1,106 @@
+from chrisClient import ANONYMIZE_PIPELINE, NEURO_PIPELINE
+
+
+def cached_template(cache, cube_url: str, pipeline_name: str):
+    """
+    A pipeline template remembered by a previous run, if any
+    """
+    if not cache:
+        return None
+    return cache.get("pipeline", cube_url.rstrip('/'), {"name": pipeline_name})
+
+
+def plan_sheet(l_job, df_rejected, df_duplicate, df_skipped, pacs_name: str, cube_url: str, cache=None,
+               metrics=None) -> dict:
+    """
+    Compute the request plan of one job table from cached metadata only:
+    rows to process, PACS queries and retrieves, workflows and plugin
+    instances to create, and the number of files expected from PACS.
+    With a metrics store, the run time of the pending rows (summed over
+    rows, before any parallelism) is estimated from past runs.
+    Nothing is sent to PACS or CUBE.
+    """
+    d_plan = {
+        "rows": len(l_job) + len(df_rejected) + len(df_duplicate) + len(df_skipped),
+        "rejected": len(df_rejected),
+        "duplicates": len(df_duplicate),
+        "skipped": len(df_skipped),
+        "done": 0,
+        "pending": 0,
+        "cache_hits": 0,
+        "cache_misses": 0,
+        "no_data": 0,
+        "pacs_queries": 0,
+        "pacs_retrieves": 0,
+        "workflows": 0,
+        "neuro_pulls": 0,
+        "plugin_instances": 0,
+        "files": 0,
+        "estimated_duration_s": 0.0 if metrics else None
+    }
+    n_anonymize = 0
+    n_neuro = 0
+    neuro_groups = set()
+    for d_job in l_job:
+        if d_job["push"].get("status"):
+            d_plan["done"] += 1
+            continue
+        d_plan["pending"] += 1
+
+        d_resolved = cache.get("autocomplete", pacs_name, dict(d_job["search"])) if cache else None
+        if d_resolved is None:
+            d_plan["cache_misses"] += 1
+        else:
+            d_plan["cache_hits"] += 1
+            d_plan["files"] += d_resolved["file_count"]
+            if d_resolved["file_count"] == 0:
+                d_plan["no_data"] += 1
+                continue
+
+        n_anonymize += 1
+        search = d_job["search"]
+        l_stage = ["submit", "retrieve"]
+        if search.get("neuro"):
+            n_neuro += 1
+            neuro_groups.add((search["neuro"], search.get("PatientID"), search.get("StudyDate")))
+            l_stage.append("anonymize")
+
+        if d_plan["estimated_duration_s"] is not None:
+            estimate = metrics.estimate_job(l_stage, pacs_name, search.get("Modality"),
+                                            d_resolved["file_count"] if d_resolved else None)
+            d_plan["estimated_duration_s"] = None if estimate is None else d_plan["estimated_duration_s"] + estimate
+
+    d_plan["pacs_queries"] = n_anonymize
+    d_plan["pacs_retrieves"] = n_anonymize
+    d_plan["neuro_pulls"] = len(neuro_groups)
+    d_plan["workflows"] = n_anonymize + n_neuro
+
+    instances = len(neuro_groups)
+    for pipeline_name, count in ((ANONYMIZE_PIPELINE, n_anonymize), (NEURO_PIPELINE, n_neuro)):
+        template = cached_template(cache, cube_url, pipeline_name)
+        if count and template is None:
+            instances = None
+            break
+        if count:
+            instances += count * template["total_jobs"]
+    d_plan["plugin_instances"] = instances
+    if d_plan["estimated_duration_s"] is not None:
+        d_plan["estimated_duration_s"] = round(d_plan["estimated_duration_s"], 1)
+    return d_plan
+
+
+def combine_plans(d_sheets: dict) -> dict:
+    """
+    Totals over the plans of several sheets. Unknown (``None``) counts
+    make the total unknown.
+    """
+    d_total = {}
+    for d_plan in d_sheets.values():
+        for key, value in d_plan.items():
+            if key not in d_total:
+                d_total[key] = value
+            elif d_total[key] is None or value is None:
+                d_total[key] = None
+            else:
+                d_total[key] += value
+    return d_total
@@ -0,0 +1,158 @@
+import asyncio
+import collections
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+
+# Stack frames of the profiler itself, left out of the samples
+OWN_FILE = __file__
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+def _thread_cpu_clock(ident: int):
+    try:
+        return time.pthread_getcpuclockid(ident)
+    except (AttributeError, OSError):
+        return None
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler of the whole process.
+
+    A background thread samples the stacks of all threads every
+    ``interval`` seconds. Every sample counts towards the wall-clock
+    profile; it also counts towards the CPU profile if the thread's CPU
+    clock advanced since the previous sample (threads blocked on I/O do
+    not). Stacks of threads running an event loop are prefixed with the
+    name of the asyncio task being run.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.wall = collections.Counter()
+        self.cpu = collections.Counter()
+        self.samples = 0
+        self.cpu_times = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self.started = None
+        self.duration = 0.0
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.duration = time.perf_counter() - self.started
+
+    def _task_names(self) -> dict:
+        """
+        Name of the asyncio task currently run by each thread
+        """
+        d_task = {}
+        for loop, task in list(getattr(asyncio.tasks, "_current_tasks", {}).items()):
+            thread_id = getattr(loop, "_thread_id", None)
+            if thread_id is not None and task is not None:
+                d_task[thread_id] = f"task {task.get_name()}"
+        return d_task
+
+    def _run(self):
+        own = threading.get_ident()
+        d_name = {}
+        while not self.stopped.wait(self.interval):
+            d_task = self._task_names()
+            self.samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in d_name:
+                    d_name = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    if frame.f_code.co_filename != OWN_FILE:
+                        stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                if ident in d_task:
+                    stack.append(d_task[ident])
+                stack.append(f"thread {d_name.get(ident, ident)}")
+                key = tuple(reversed(stack))
+                self.wall[key] += 1
+                if self._on_cpu(ident):
+                    self.cpu[key] += 1
+
+    def _on_cpu(self, ident: int) -> bool:
+        clock = _thread_cpu_clock(ident)
+        if clock is None:
+            return False
+        try:
+            now = time.clock_gettime(clock)
+        except OSError:
+            return False
+        previous = self.cpu_times.get(ident)
+        self.cpu_times[ident] = now
+        return previous is not None and now > previous
+
+    def top(self, counter: collections.Counter, n: int) -> list[tuple]:
+        """
+        The ``n`` functions with the most samples, as
+        (function, self samples, total samples)
+        """
+        self_samples = collections.Counter()
+        total_samples = collections.Counter()
+        for stack, count in counter.items():
+            self_samples[stack[-1]] += count
+            for label in set(stack):
+                total_samples[label] += count
+        l_label = sorted(total_samples, key=lambda label: (self_samples[label], total_samples[label]), reverse=True)
+        return [(label, self_samples[label], total_samples[label]) for label in l_label[:n]]
+
+    def write(self, outputdir: Path, top_n: int = 25):
+        """
+        Write the collapsed stacks (``profile.collapsed``, wall clock), a
+        speedscope file with the wall-clock and CPU profiles
+        (``profile.speedscope.json``) and the top functions of both
+        (``profile.txt``) to ``outputdir``
+        """
+        outputdir = Path(outputdir)
+        with open(outputdir / "profile.collapsed", "w") as f:
+            for stack, count in self.wall.most_common():
+                f.write(f"{';'.join(stack)} {count}\n")
+
+        frames = {}
+        l_profile = []
+        for name, counter in (("wall clock", self.wall), ("cpu", self.cpu)):
+            l_sample = [[frames.setdefault(label, len(frames)) for label in stack] for stack in counter]
+            l_profile.append({
+                "type": "sampled",
+                "name": name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(counter.values()) * self.interval,
+                "samples": l_sample,
+                "weights": [count * self.interval for count in counter.values()]
+            })
+        speedscope = {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": [{"name": label} for label in frames]},
+            "profiles": l_profile,
+            "name": "dypxFlow",
+            "exporter": "dypxFlow profiler"
+        }
+        (outputdir / "profile.speedscope.json").write_text(json.dumps(speedscope))
+
+        lines = [f"{self.samples} samples every {self.interval * 1000:.1f}ms over {self.duration:.1f}s", ""]
+        for name, counter in (("wall clock", self.wall), ("cpu", self.cpu)):
+            lines.append(f"Top {top_n} functions by {name} samples (self, total):")
+            for label, self_count, total_count in self.top(counter, top_n):
+                lines.append(f"{self_count:8d} {total_count:8d}  {label}")
+            lines.append("")
+        (outputdir / "profile.txt").write_text("\n".join(lines))
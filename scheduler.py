@@ -0,0 +1,141 @@
+import concurrent.futures
+import threading
+from collections import deque
+from loguru import logger
+
+LOG = logger.debug
+
+# Default lanes and their share of the worker budget
+LANE_WEIGHTS = {"clinical": 8, "normal": 2, "research": 1}
+
+
+def parse_lane_weights(spec: str) -> dict:
+    """
+    Parse lane weights given as ``lane:weight,lane:weight``
+    """
+    d_weight = {}
+    for entry in filter(None, (entry.strip() for entry in spec.split(","))):
+        lane, _, weight = entry.partition(":")
+        d_weight[lane.strip().lower()] = max(1, int(weight or 1))
+    return d_weight or dict(LANE_WEIGHTS)
+
+
+class LaneScheduler:
+    """
+    Weighted fair scheduler of jobs across priority lanes.
+
+    Jobs are only taken off their lane when a worker is free, so a job
+    submitted to a heavier lane overtakes every queued (not yet started)
+    job of lighter lanes, while lighter lanes still get their weighted
+    share of the workers and never starve.
+    """
+
+    def __init__(self, weights: dict = None):
+        self.weights = dict(weights or LANE_WEIGHTS)
+        self.lanes = {lane: deque() for lane in self.weights}
+        self.credit = {lane: 0 for lane in self.weights}
+        self.lock = threading.Lock()
+
+    def submit(self, lane: str, item):
+        with self.lock:
+            self.lanes[lane if lane in self.lanes else self.default_lane()].append(item)
+
+    def default_lane(self) -> str:
+        return "normal" if "normal" in self.lanes else min(self.lanes, key=self.weights.get)
+
+    def next(self):
+        """
+        Pick the next job by smooth weighted round robin over non-empty
+        lanes, or ``None`` once all lanes are empty
+        """
+        with self.lock:
+            l_ready = [lane for lane, queue in self.lanes.items() if queue]
+            if not l_ready:
+                return None
+            total = sum(self.weights[lane] for lane in l_ready)
+            for lane in l_ready:
+                self.credit[lane] += self.weights[lane]
+            lane = max(l_ready, key=self.credit.get)
+            self.credit[lane] -= total
+            return self.lanes[lane].popleft()
+
+    def drain(self) -> list:
+        """
+        All queued jobs in scheduling order
+        """
+        l_item = []
+        while (item := self.next()) is not None:
+            l_item.append(item)
+        return l_item
+
+    def run(self, fn, max_workers: int):
+        """
+        Run ``fn`` on every queued job with ``max_workers`` worker threads.
+        Jobs submitted while running are picked up too.
+        """
+        def worker():
+            while (item := self.next()) is not None:
+                try:
+                    fn(item)
+                except Exception as ex:
+                    LOG(f"Job failed: {ex}")
+
+        l_thread = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, max_workers))]
+        for thread in l_thread:
+            thread.start()
+        for thread in l_thread:
+            thread.join()
+
+
+class LanePool:
+    """
+    Long-lived worker threads running the calls submitted to a
+    ``LaneScheduler``, for callers that keep adding jobs while earlier
+    ones run (e.g. the sheets of watch mode). Workers wait for new jobs
+    until the pool is shut down.
+    """
+
+    def __init__(self, scheduler: LaneScheduler, max_workers: int):
+        self.scheduler = scheduler
+        self.cond = threading.Condition()
+        self.closed = False
+        self.threads = [threading.Thread(target=self._worker, name=f"lane-worker-{i}", daemon=True)
+                        for i in range(max(1, max_workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, lane: str, fn, *args) -> concurrent.futures.Future:
+        """
+        Queue ``fn(*args)`` on ``lane`` and return the future of its result
+        """
+        future = concurrent.futures.Future()
+        with self.cond:
+            self.scheduler.submit(lane, (future, fn, args))
+            self.cond.notify()
+        return future
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while (item := self.scheduler.next()) is None:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+            future, fn, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as ex:
+                LOG(f"Job failed: {ex}")
+                future.set_exception(ex)
+
+    def shutdown(self):
+        """
+        Run the queued jobs, then stop the workers
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
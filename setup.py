@@ -25,7 +25,7 @@ setup(
     author='FNNDSC',
     author_email='dev@babyMRI.org',
     url='https://github.com/FNNDSC/pl-dypxFlow',
-    py_modules=['dypxFlow','base_client','chrisClient','pfdcm','chris_pacs_service','pipeline','notification'],
+    py_modules=['dypxFlow','base_client','chrisClient','pfdcm','chris_pacs_service','pipeline','notification','pacs_cache','jobs','validation','log_config','tracker','coalesce','scheduler','planner','metrics','context','watcher','limiter','backpressure','streamer','transport','profiler','traffic','sheets'],
     install_requires=['chris_plugin'],
     license='MIT',
     entry_points={
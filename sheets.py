@@ -0,0 +1,116 @@
+import csv
+import json
+from pathlib import Path
+import pandas as pd
+from loguru import logger
+
+LOG = logger.debug
+
+# Rows buffered before writing a Parquet row group
+BATCH_ROWS = 10000
+
+SHEET_FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".parquet": "parquet", ".pq": "parquet"}
+
+
+def sheet_format(path: Path) -> str:
+    """
+    The format of a request sheet from its suffix (CSV if unknown)
+    """
+    return SHEET_FORMATS.get(Path(path).suffix.lower(), "csv")
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.parquet
+    except ImportError as ex:
+        raise ImportError("Parquet sheets require pyarrow (pip install pyarrow)") from ex
+    return pyarrow
+
+
+def read_sheet(path: Path) -> pd.DataFrame:
+    """
+    Read a CSV, JSONL or Parquet request sheet with every value as a
+    string and missing values as NaN
+    """
+    fmt = sheet_format(path)
+    if fmt == "csv":
+        return pd.read_csv(path, dtype=str)
+
+    if fmt == "jsonl":
+        # values are stringified before pandas sees them, so that e.g. integer
+        # accession numbers of a column with gaps do not become floats
+        with open(path) as f:
+            l_row = [{key: None if value is None else str(value) for key, value in json.loads(line).items()}
+                     for line in f if line.strip()]
+        df = pd.DataFrame.from_records(l_row)
+    else:
+        pa = _pyarrow()
+        table = pa.parquet.read_table(path)
+        df = pa.table([pa.compute.cast(column, pa.string()) for column in table.columns],
+                      names=table.column_names).to_pandas()
+    LOG(f"Read {len(df)} rows of {Path(path).name}")
+    return df
+
+
+class SheetWriter:
+    """
+    Write the result rows of a sheet as they complete, in the format of
+    its suffix: CSV and JSONL rows are flushed one by one (so the file can
+    be tailed), Parquet rows in row groups of ``batch_rows``.
+    """
+
+    def __init__(self, path: Path, columns: list[str], batch_rows: int = BATCH_ROWS):
+        self.path = Path(path)
+        self.columns = list(dict.fromkeys(columns))
+        self.format = sheet_format(path)
+        self.batch_rows = batch_rows
+        self.buffer = []
+        self.count = 0
+        if self.format == "parquet":
+            pa = _pyarrow()
+            self.schema = pa.schema([(column, pa.string()) for column in self.columns])
+            self.writer = pa.parquet.ParquetWriter(self.path, self.schema)
+        else:
+            self.file = open(self.path, "w", newline="")
+            if self.format == "csv":
+                self.writer = csv.DictWriter(self.file, self.columns, restval="")
+                self.writer.writeheader()
+
+    def write(self, d_row: dict):
+        row = {column: d_row.get(column, "") for column in self.columns}
+        self.count += 1
+        if self.format == "csv":
+            self.writer.writerow(row)
+            self.file.flush()
+        elif self.format == "jsonl":
+            self.file.write(json.dumps(row, default=str) + "\n")
+            self.file.flush()
+        else:
+            self.buffer.append(row)
+            if len(self.buffer) >= self.batch_rows:
+                self._write_row_group()
+
+    def _write_row_group(self):
+        pa = _pyarrow()
+        table = pa.Table.from_pylist([{column: None if value is None else str(value)
+                                       for column, value in row.items()} for row in self.buffer],
+                                     schema=self.schema)
+        self.writer.write_table(table)
+        self.buffer = []
+
+    def close(self):
+        if self.format == "parquet":
+            if self.buffer:
+                self._write_row_group()
+            self.writer.close()
+        else:
+            self.file.close()
+        LOG(f"Wrote {self.count} rows to {self.path.name}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
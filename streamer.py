@@ -0,0 +1,73 @@
+import time
+from loguru import logger
+
+LOG = logger.debug
+
+
+class SeriesStreamer:
+    """
+    Hand the series of retrieving jobs over to the next stage one by one.
+
+    The registration progress of every expected series (file counts from
+    the PACS status query) is polled from CUBE, and a series is submitted
+    as soon as all of its files are registered, while the other series of
+    its study are still being retrieved. A series without progress for
+    ``stall_timeout`` seconds is given up. Rows resolving to the same
+    series each get it handed over.
+    """
+
+    def __init__(self, cube_con, poll_interval: float = 20, stall_timeout: float = 3600, max_workers: int = 4):
+        self.cube_con = cube_con
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+        self.max_workers = max_workers
+        self.pending = {}
+        self.results = {}
+
+    def add(self, d_job):
+        """
+        Expect the resolved series of a job whose retrieve was requested
+        """
+        now = time.monotonic()
+        self.results[d_job] = []
+        for part, series in enumerate(d_job["resolved"]["series"]):
+            self.pending[(d_job, series["SeriesInstanceUID"])] = {
+                "job": d_job, "series": series, "part": part, "count": 0, "progress": now
+            }
+
+    def run(self, submit) -> dict:
+        """
+        Poll until every series is handed over or given up, calling
+        ``submit(d_job, series, part, folder_path)`` for each complete
+        series. Returns the responses of each job's series.
+        """
+        while self.pending:
+            l_uid = list(dict.fromkeys(uid for _, uid in self.pending))
+            d_progress = self.cube_con.get_series_progress(l_uid, self.max_workers)
+            now = time.monotonic()
+            for (d_job, uid), d_series in list(self.pending.items()):
+                if uid not in d_progress:
+                    continue
+                count, folder_path = d_progress[uid]
+                if count > d_series["count"]:
+                    d_series["count"] = count
+                    d_series["progress"] = now
+                if count >= d_series["series"]["file_count"] and folder_path:
+                    del self.pending[(d_job, uid)]
+                    LOG(f"Series {uid} registered ({count} files), submitting")
+                    try:
+                        d_ret = submit(d_job, d_series["series"], d_series["part"], folder_path)
+                    except Exception as ex:
+                        d_ret = {"status": "Failed", "error": str(ex)}
+                    self.results[d_job].append(d_ret)
+            for (d_job, uid), d_series in list(self.pending.items()):
+                if now - d_series["progress"] > self.stall_timeout:
+                    del self.pending[(d_job, uid)]
+                    self.results[d_job].append({
+                        "status": "Failed",
+                        "error": f"Series {uid} stalled at {d_series['count']}/{d_series['series']['file_count']} files"
+                    })
+            if self.pending:
+                LOG(f"Waiting for {len(self.pending)} series to register")
+                time.sleep(self.poll_interval)
+        return self.results
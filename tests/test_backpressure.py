@@ -0,0 +1,70 @@
+import threading
+
+from backpressure import BackpressureGate
+from transport import DeadlineExceeded, deadline, remaining
+
+
+class FakePipe:
+    def __init__(self, l_total=(), d_pending=None):
+        self.l_total = list(l_total)
+        self.d_pending = d_pending or {}
+        self.samples = 0
+        self.deadlines = []
+
+    def count_plugin_instances(self, states):
+        self.samples += 1
+        self.deadlines.append(remaining())
+        total = self.l_total.pop(0) if self.l_total else None
+        if isinstance(total, Exception):
+            raise total
+        return total
+
+    def _get_workflow_status(self, workflow_id):
+        return {"pending_jobs": self.d_pending[workflow_id]}
+
+
+def gate_with(pipe, max_pending=10, interval=0.01) -> BackpressureGate:
+    gate = BackpressureGate(context=None, max_pending=max_pending, interval=interval)
+    gate.pipe = pipe
+    return gate
+
+
+def test_gate_holds_submissions_above_the_threshold():
+    pipe = FakePipe([50, 30, 5])
+    gate = gate_with(pipe)
+    thread = threading.Thread(target=gate.wait)
+    thread.start()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert pipe.samples == 3 and gate.pending() <= 10
+
+
+def test_submissions_count_until_the_next_sample():
+    gate = gate_with(FakePipe([4, 4]), interval=60)
+    gate.wait()
+    gate.add(1, 8)
+    assert gate.pending() == 12
+
+
+def test_falls_back_to_the_pending_jobs_of_submitted_workflows():
+    pipe = FakePipe(d_pending={1: 6, 2: 0})
+    gate = gate_with(pipe, interval=0)
+    gate.add(1, 6)
+    gate.add(2, 3)
+
+    assert gate.pending() == 6
+    assert not gate.cube_wide and gate.workflows == {1}
+
+
+def test_failed_sample_keeps_the_last_depth_and_mode():
+    pipe = FakePipe([50, ConnectionError('CUBE busy'), DeadlineExceeded('no time left'), 5])
+    gate = gate_with(pipe, interval=0)
+    with deadline(30):
+        assert gate.pending() == 50
+        assert gate.pending() == 50
+        assert gate.pending() == 50
+        assert gate.pending() == 5
+    assert gate.cube_wide
+    # samples are taken outside the deadline of the submitting row
+    assert pipe.deadlines == [None] * 4
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+from coalesce import Coalescer
+
+
+def test_concurrent_callers_share_one_call():
+    coalescer = Coalescer()
+    started = threading.Event()
+    release = threading.Event()
+    l_call = []
+
+    def fetch():
+        l_call.append(1)
+        started.set()
+        release.wait(5)
+        return {'feed': 7}
+
+    l_result = []
+    l_thread = [threading.Thread(target=lambda: l_result.append(coalescer.get(('feed', 1), fetch)))
+                for _ in range(4)]
+    l_thread[0].start()
+    started.wait(5)
+    for thread in l_thread[1:]:
+        thread.start()
+    # let the other callers find the call in flight
+    time.sleep(0.05)
+    release.set()
+    for thread in l_thread:
+        thread.join()
+
+    assert len(l_call) == 1
+    assert l_result == [{'feed': 7}] * 4
+    assert coalescer.get(('feed', 1), lambda: pytest.fail('cached value refetched')) == {'feed': 7}
+
+
+def test_failures_are_not_cached():
+    coalescer = Coalescer()
+
+    def fail():
+        raise ConnectionError('CUBE down')
+
+    with pytest.raises(ConnectionError):
+        coalescer.get('key', fail)
+    assert coalescer.get('key', lambda: 42) == 42
+    assert not coalescer.inflight
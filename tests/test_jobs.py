@@ -0,0 +1,75 @@
+from argparse import Namespace
+
+import pandas as pd
+
+from dypxFlow import create_query, neuro_filters, row_result, split_jobs
+
+SERIES = [{'SeriesInstanceUID': '1.1', 'file_count': 300}, {'SeriesInstanceUID': '1.2', 'file_count': 200}]
+
+
+def table():
+    df = pd.DataFrame({'search_PatientID': ['1', '2'], 'search_StudyDate': ['20200101', '20200202'],
+                       'Folder name': ['f1', 'f2']})
+    l_job = create_query(df)
+    l_job[0]['resolved'] = {'directive': {'PatientID': '1'}, 'file_count': 500, 'series': SERIES}
+    l_job[1]['resolved'] = {'directive': {'PatientID': '2'}, 'file_count': 500, 'series': SERIES[:1]}
+    split_jobs(Namespace(maxSeriesInstances=100), l_job)
+    return l_job
+
+
+def test_large_multi_series_rows_are_split_by_series():
+    l_job = table()
+    assert [(d_job.index, d_job.part, d_job['search'].get('SeriesInstanceUID')) for d_job in l_job] == \
+        [(0, 0, '1.1'), (0, 1, '1.2'), (1, 0, None)]
+    assert [d_job['resolved']['file_count'] for d_job in l_job] == [300, 200, 500]
+
+
+def test_split_rows_aggregate_their_status():
+    l_job = table()
+    part_1, part_2, row_2 = l_job
+    part_1['response'] = {'status': 'Pipeline running', 'workflow_id': 7, 'workflows': [(7, 'anonymize')]}
+    part_1['timing'] = {'submit': 1.5}
+    part_2['response'] = {'status': 'Failed', 'error': 'PACS timeout', 'workflows': []}
+    part_2['timing'] = {'submit': 0.5}
+    row_2['response'] = {'status': 'Pipeline running', 'workflow_id': 9, 'workflows': [(9, 'anonymize')]}
+
+    (_, l_part), (_, l_single) = l_job.rows()
+    d_result, failed = row_result(l_part)
+    assert failed
+    assert d_result == {'status': 'Failed', 'workflow_id': '7', 'sub_jobs': 2, 'submit_s': 2.0}
+
+    d_result, failed = row_result(l_single)
+    assert not failed
+    assert d_result == {'status': 'Pipeline running', 'workflow_id': '9'}
+
+
+class FakeChrisClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_registered_series(self, l_filter, max_workers=4):
+        return {'1.1': 'SERVICES/PACS/1.1', '1.2': 'SERVICES/PACS/1.2'}
+
+    def get_series_progress(self, l_uid, max_workers=4):
+        # the retrieve of 1.2 was interrupted
+        return {'1.1': (300, 'SERVICES/PACS/1.1'), '1.2': (150, 'SERVICES/PACS/1.2')}
+
+
+def test_only_fully_registered_series_skip_the_pull(monkeypatch):
+    import chrisClient
+    import dypxFlow
+
+    monkeypatch.setattr(chrisClient, 'ChrisClient', FakeChrisClient)
+    monkeypatch.setattr(dypxFlow, 'run_context', lambda options: None)
+    l_job = table()
+    dypxFlow.find_registered_jobs(Namespace(CUBEurl='', CUBEtoken='', maxThreads=1), l_job)
+
+    assert [d_job.get('registered') for d_job in l_job] == [['SERVICES/PACS/1.1'], None, ['SERVICES/PACS/1.1']]
+
+
+def test_rows_of_one_study_share_the_neuro_pull():
+    l_search = [{"neuro": "/neuro", "PatientID": "P1", "StudyDate": "20240101", "sequence": sequence}
+                for sequence in ("T1", "FLAIR", "T1")]
+    l_search.append({"neuro": "/neuro", "PatientID": "P2", "StudyDate": "20240101", "sequence": "T1"})
+    assert neuro_filters(l_search) == [("P1_20240101", "*P1*/*20240101*/**")] * 3 + [
+        ("P2_20240101_T1", "*P2*/*20240101*/*T1*/**")]
@@ -0,0 +1,45 @@
+import requests
+
+from limiter import AdaptiveLimiter, endpoint
+
+
+def saturate(limiter: AdaptiveLimiter, latency: float, failure: str = None, endpoints=(None,)):
+    slots = int(limiter.limit)
+    for _ in range(slots):
+        limiter.acquire()
+    for i in range(slots):
+        limiter.release(latency[i % len(latency)] if isinstance(latency, tuple) else latency, failure,
+                        endpoints[i % len(endpoints)])
+
+
+def test_limit_grows_while_healthy_and_is_cut_on_errors():
+    limiter = AdaptiveLimiter('cube', min_limit=2, max_limit=8, initial=2, cooldown=0)
+    for _ in range(20):
+        saturate(limiter, 0.1)
+    assert int(limiter.limit) == 8
+
+    saturate(limiter, 0.1, 'HTTP 503')
+    assert int(limiter.limit) == 2
+
+    saturate(limiter, 5.0)
+    assert int(limiter.limit) == 2
+    assert [d['new_limit'] for d in limiter.drain_decisions()][-1] == 2
+    assert limiter.drain_decisions() == []
+
+
+def test_slow_endpoint_does_not_cut_the_limit():
+    limiter = AdaptiveLimiter('pfdcm', min_limit=2, max_limit=8, initial=2, cooldown=0)
+    endpoints = ('GET /api/v1/about/', 'POST /api/v1/PACS/sync/pypx/')
+    for _ in range(20):
+        saturate(limiter, (0.01, 2.0), endpoints=endpoints)
+    assert int(limiter.limit) == 8
+    assert all(d['reason'] == 'healthy' for d in limiter.drain_decisions())
+
+    # a spike is still detected against the baseline of its endpoint
+    saturate(limiter, 20.0, endpoints=endpoints[1:])
+    assert int(limiter.limit) < 8
+
+
+def test_endpoint_ignores_ids_and_query():
+    request = requests.Request('GET', 'http://cube/api/v1/plugins/instances/123/?limit=1').prepare()
+    assert endpoint(request) == 'GET /api/v1/plugins/instances/:id/'
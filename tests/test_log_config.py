@@ -0,0 +1,8 @@
+from log_config import redact, register_phi
+
+
+def test_redact_masks_patient_ids():
+    assert redact("{'PatientID': '4431', 'Modality': 'MR'}") == "{'PatientID': '***', 'Modality': 'MR'}"
+
+    register_phi(['X99812', ' '])
+    assert redact("Created new analysis: X99812_20240101_T1") == "Created new analysis: ***_20240101_T1"
@@ -0,0 +1,24 @@
+from pathlib import Path
+
+from metrics import MetricsStore
+
+
+def test_estimate_scales_by_instances_and_relaxes_filters(tmp_path: Path):
+    metrics = MetricsStore(str(tmp_path))
+    assert metrics.estimate('retrieve', 'PACS', 'MR', 10) is None
+
+    metrics.record([
+        {'pacs': 'PACS', 'modality': 'MR', 'instances': 100, 'stage': 'retrieve', 'duration_s': 50.0, 'status': 'finished'},
+        {'pacs': 'PACS', 'modality': 'MR', 'instances': 300, 'stage': 'retrieve', 'duration_s': 150.0, 'status': 'finished'},
+        {'pacs': 'PACS', 'modality': 'MR', 'instances': 100, 'stage': 'retrieve', 'duration_s': 900.0, 'status': 'errored'},
+        {'pacs': 'PACS', 'modality': 'CT', 'stage': 'submit', 'duration_s': 2.0, 'status': 'finished'},
+        # no instance count: left out of the scaled estimate
+        {'pacs': 'PACS', 'modality': 'MR', 'stage': 'retrieve', 'duration_s': 1000.0, 'status': 'finished'},
+    ])
+
+    assert metrics.estimate('retrieve', 'PACS', 'MR', 10) == 5.0
+    assert metrics.estimate('retrieve', 'PACS', 'CT', 10) == 5.0
+    assert metrics.estimate('submit', 'PACS', 'MR') == 2.0
+    assert metrics.estimate('retrieve', 'PACS', 'MR') == 400.0
+    assert metrics.estimate_job(['submit', 'retrieve'], 'PACS', 'MR', 10) == 7.0
+    assert metrics.estimate_job(['submit', 'anonymize'], 'PACS', 'MR', 10) is None
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+from pacs_cache import PACSCache
+
+
+def test_cache_hit_is_keyed_by_normalized_directive(tmp_path: Path):
+    cache = PACSCache(str(tmp_path))
+    cache.put('autocomplete', 'PACS', {'PatientID': ' 123 ', 'Modality': ''}, {'file_count': 4})
+
+    assert cache.get('autocomplete', 'PACS', {'PatientID': '123'}) == {'file_count': 4}
+    assert cache.get('autocomplete', 'OTHER', {'PatientID': '123'}) is None
+    assert cache.get('status', 'PACS', {'PatientID': '123'}) is None
+
+
+def test_cache_expires_and_evicts(tmp_path: Path):
+    expired = PACSCache(str(tmp_path / 'ttl'), ttl=-1)
+    expired.put('status', 'PACS', {'PatientID': '1'}, {'status': True})
+    assert expired.get('status', 'PACS', {'PatientID': '1'}) is None
+
+    small = PACSCache(str(tmp_path / 'size'), max_bytes=40)
+    small.put('status', 'PACS', {'PatientID': '1'}, {'payload': 'x' * 20})
+    small.put('status', 'PACS', {'PatientID': '2'}, {'payload': 'y' * 20})
+    assert small.get('status', 'PACS', {'PatientID': '1'}) is None
+    assert small.get('status', 'PACS', {'PatientID': '2'}) == {'payload': 'y' * 20}
+
+
+def test_directives_without_data_are_not_cached(tmp_path: Path, monkeypatch):
+    import pfdcm
+
+    d_series = {'SeriesInstanceUID': {'value': '1.2'}, 'StudyInstanceUID': {'value': '1'},
+                'NumberOfSeriesRelatedInstances': {'value': '3'}, 'PatientID': {'value': '123'}}
+    d_data = {'pypx': {'data': []}}
+    l_call = []
+
+    def status(directive, url, pacs_name, cache=None):
+        l_call.append(directive)
+        return d_data
+
+    monkeypatch.setattr(pfdcm, 'get_pfdcm_status', status)
+    cache = PACSCache(str(tmp_path))
+    assert pfdcm.resolve_directive({'PatientID': '123'}, '', 'PACS', cache)['file_count'] == 0
+    # the study arrives in PACS
+    d_data['pypx']['data'] = [{'series': [d_series]}]
+    assert pfdcm.resolve_directive({'PatientID': '123'}, '', 'PACS', cache)['file_count'] == 3
+    assert pfdcm.resolve_directive({'PatientID': '123'}, '', 'PACS', cache)['file_count'] == 3
+    assert len(l_call) == 2
@@ -0,0 +1,89 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from context import RunContext
+from pipeline import Pipeline
+
+
+class NoETags(BaseHTTPRequestHandler):
+    """
+    CUBE plugin instance search without ETags: every poll is a full response
+    """
+    status = {}
+    requests = []
+
+    def do_GET(self):
+        query = parse_qs(urlsplit(self.path).query)
+        title = query['title'][0]
+        NoETags.requests.append(title)
+        data = [{'name': 'title', 'value': title}, {'name': 'status', 'value': NoETags.status[title]}]
+        body = json.dumps({'collection': {'items': [{'data': data}]}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def pipe():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), NoETags)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield Pipeline('', '', context=RunContext(f'http://127.0.0.1:{httpd.server_port}/api/v1', 'token'))
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_finished_leaves_are_not_polled_again(pipe):
+    NoETags.status = {'dcm2niix': 'finished', 'push': 'started'}
+    NoETags.requests = []
+    leaves = ['dcm2niix', 'push']
+
+    status = pipe._get_workflow_leaf_status(7, leaves)
+    assert (status['finished_jobs'], status['total_jobs']) == (1, 2)
+    NoETags.status['push'] = 'finished'
+    status = pipe._get_workflow_leaf_status(7, leaves)
+    assert (status['finished_jobs'], status['total_jobs']) == (2, 2)
+    assert NoETags.requests == ['dcm2niix', 'push', 'push']
+
+    assert not pipe.etags
+    # as kept from a CUBE that sends ETags
+    pipe.etags[pipe._leaf_endpoint(7, 'push')] = ('"1"', [])
+    pipe.forget_workflow(7, leaves)
+    assert not pipe.etags and 7 not in pipe.finished_leaves
+
+
+class NoId(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'collection': {'items': [{'data': [{'name': 'title', 'value': 'wf'}]}]}}).encode()
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_workflow_without_id_is_a_failed_submission():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), NoId)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    pipe = Pipeline('', '', context=RunContext(f'http://127.0.0.1:{httpd.server_port}/api/v1', 'token'))
+    try:
+        with pytest.raises(Exception, match='No workflow ID'):
+            pipe.post_workflow(1, 2, [])
+        assert pipe.post_workflows(1, [(2, []), (3, [])]) == [(-1, pytest.approx(time.time(), abs=5))] * 2
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+    assert pipe.context._tracker is None
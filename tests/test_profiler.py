@@ -0,0 +1,43 @@
+import asyncio
+import json
+import time
+
+from profiler import SamplingProfiler
+
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+async def waiter():
+    await asyncio.sleep(0.2)
+    spin(0.2)
+
+
+async def run_task():
+    await asyncio.create_task(waiter(), name='row-1')
+
+
+def test_profile_cpu_wall_and_tasks(tmp_path):
+    profiler = SamplingProfiler(0.002)
+    profiler.start()
+    asyncio.run(run_task())
+    time.sleep(0.2)
+    profiler.stop()
+    profiler.write(tmp_path, top_n=5)
+
+    # spinning shows up on CPU, sleeping only in wall clock
+    cpu_functions = {stack[-1] for stack in profiler.cpu}
+    wall_functions = {label for stack in profiler.wall for label in stack}
+    assert any(label.startswith('spin ') for label in cpu_functions)
+    assert any(label.startswith('test_profile_cpu_wall_and_tasks ') for label in wall_functions)
+    assert sum(profiler.cpu.values()) < 0.75 * sum(profiler.wall.values())
+    assert any(stack[1] == 'task row-1' for stack in profiler.wall if len(stack) > 1)
+
+    collapsed = (tmp_path / 'profile.collapsed').read_text().splitlines()
+    assert collapsed and collapsed[0].startswith('thread MainThread;')
+    speedscope = json.loads((tmp_path / 'profile.speedscope.json').read_text())
+    assert [p['name'] for p in speedscope['profiles']] == ['wall clock', 'cpu']
+    assert 'Top 5 functions by cpu samples' in (tmp_path / 'profile.txt').read_text()
@@ -0,0 +1,46 @@
+import threading
+import time
+from collections import deque
+
+from scheduler import LanePool, LaneScheduler, parse_lane_weights
+
+
+def test_heavier_lanes_go_first_and_lighter_lanes_keep_their_share():
+    scheduler = LaneScheduler({'clinical': 8, 'normal': 2, 'research': 1})
+    for lane in ('research', 'normal', 'clinical'):
+        for i in range(20):
+            scheduler.submit(lane, (lane, i))
+
+    l_item = scheduler.drain()
+    assert l_item[0] == ('clinical', 0)
+    l_lane = [lane for lane, _ in l_item[:11]]
+    assert (l_lane.count('clinical'), l_lane.count('normal'), l_lane.count('research')) == (8, 2, 1)
+    # within a lane, jobs keep their order
+    assert [i for lane, i in l_item if lane == 'research'] == list(range(20))
+
+
+def test_unknown_lane_falls_back_to_normal():
+    scheduler = LaneScheduler(parse_lane_weights('clinical:4, normal'))
+    assert scheduler.weights == {'clinical': 4, 'normal': 1}
+    scheduler.submit('urgent', 'job')
+    assert scheduler.lanes['normal'] == deque(['job'])
+    assert parse_lane_weights('') == {'clinical': 8, 'normal': 2, 'research': 1}
+
+
+def test_pool_keeps_serving_lanes_across_submissions():
+    pool = LanePool(LaneScheduler({'clinical': 8, 'research': 1}), max_workers=1)
+    release = threading.Event()
+    l_done = []
+    blocker = pool.submit('research', release.wait)
+    l_future = [pool.submit('research', l_done.append, f'research-{i}') for i in range(3)]
+    # a sheet landing later still overtakes the queued jobs of lighter lanes
+    l_future.append(pool.submit('clinical', l_done.append, 'clinical'))
+    release.set()
+    for future in [blocker, *l_future]:
+        future.result(timeout=5)
+    assert l_done[0] == 'clinical'
+
+    # workers outlive idle periods
+    time.sleep(0.05)
+    assert pool.submit('research', lambda: 42).result(timeout=5) == 42
+    pool.shutdown()
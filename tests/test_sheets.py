@@ -0,0 +1,56 @@
+import csv
+import json
+
+import pandas as pd
+import pytest
+
+from sheets import SheetWriter, read_sheet
+
+ROWS = [
+    {'search_PatientID': '0012345', 'search_AccessionNumber': 22, 'search_StudyDate': '20200101'},
+    {'search_PatientID': '0067890', 'search_AccessionNumber': None, 'search_StudyDate': '20210202'},
+    {'search_PatientID': '0011111', 'search_AccessionNumber': 33, 'search_StudyDate': '20220303'},
+]
+
+
+def test_read_jsonl_as_strings(tmp_path):
+    path = tmp_path / 'sheet.jsonl'
+    path.write_text(''.join(json.dumps(row) + '\n' for row in ROWS))
+
+    df = read_sheet(path)
+    assert list(df['search_PatientID']) == ['0012345', '0067890', '0011111']
+    assert df['search_AccessionNumber'][0] == '22'
+    assert pd.isna(df['search_AccessionNumber'][1])
+    assert df['search_StudyDate'][2] == '20220303'
+
+
+@pytest.mark.parametrize('suffix', ['csv', 'jsonl'])
+def test_writer_streams_rows(tmp_path, suffix):
+    path = tmp_path / f'out.{suffix}'
+    writer = SheetWriter(path, ['search_PatientID', 'status', 'workflow_id'])
+    writer.write({'search_PatientID': '0012345', 'status': 'Success', 'workflow_id': '7,8'})
+    # flushed before the writer is closed
+    assert '0012345' in path.read_text()
+    writer.write({'search_PatientID': '0067890', 'status': 'Failed', 'submit_s': 1.5})
+    writer.close()
+
+    if suffix == 'csv':
+        rows = list(csv.DictReader(path.open()))
+    else:
+        rows = [json.loads(line) for line in path.read_text().splitlines()]
+    assert rows[1] == {'search_PatientID': '0067890', 'status': 'Failed', 'workflow_id': ''}
+
+
+def test_parquet_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    source = tmp_path / 'sheet.parquet'
+    pd.DataFrame(ROWS).to_parquet(source, row_group_size=2)
+    df = read_sheet(source)
+    assert list(df['search_PatientID']) == ['0012345', '0067890', '0011111']
+
+    path = tmp_path / 'out.parquet'
+    with SheetWriter(path, [*df.columns, 'status'], batch_rows=2) as writer:
+        for row in df.to_dict('records'):
+            writer.write({**row, 'status': 'Success'})
+    out = read_sheet(path)
+    assert len(out) == 3 and set(out['status']) == {'Success'}
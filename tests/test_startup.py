@@ -0,0 +1,24 @@
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+HEAVY_MODULES = ['pandas', 'requests', 'tenacity', 'chrisclient', 'chrisClient', 'pipeline']
+
+PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+import dypxFlow
+dypxFlow.parser.format_help()
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'loaded': [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def test_cold_start_defers_heavy_imports():
+    result = subprocess.run([sys.executable, '-c', PROBE], capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).parent.parent)
+    probe = json.loads(result.stdout.strip().splitlines()[-1])
+
+    assert probe['loaded'] == []
+    assert probe['elapsed'] < 1.0
@@ -0,0 +1,55 @@
+from streamer import SeriesStreamer
+
+
+class Job(dict):
+    __hash__ = object.__hash__
+
+
+def job(*l_series):
+    return Job(resolved={"series": [{"SeriesInstanceUID": uid, "file_count": count} for uid, count in l_series]})
+
+
+class FakeCube:
+    def __init__(self, l_progress):
+        self.l_progress = iter(l_progress)
+        self.asked = []
+
+    def get_series_progress(self, l_uid, max_workers):
+        self.asked.append(l_uid)
+        return {uid: value for uid, value in next(self.l_progress).items() if uid in l_uid}
+
+
+def test_submits_each_series_once_registered():
+    d_job = job(("1.1", 2), ("1.2", 3))
+    cube = FakeCube([{"1.1": (2, "SERVICES/PACS/1.1"), "1.2": (1, "")},
+                     {"1.2": (3, "SERVICES/PACS/1.2")}])
+    streamer = SeriesStreamer(cube, poll_interval=0)
+    streamer.add(d_job)
+
+    l_submitted = []
+    results = streamer.run(lambda d_job, series, part, folder: l_submitted.append((part, folder)) or {"status": "ok"})
+    assert l_submitted == [(0, "SERVICES/PACS/1.1"), (1, "SERVICES/PACS/1.2")]
+    assert results[d_job] == [{"status": "ok"}, {"status": "ok"}]
+
+
+def test_rows_sharing_a_series_both_get_it():
+    first, second = job(("1.1", 2)), job(("1.1", 2))
+    cube = FakeCube([{"1.1": (2, "SERVICES/PACS/1.1")}])
+    streamer = SeriesStreamer(cube, poll_interval=0)
+    streamer.add(first)
+    streamer.add(second)
+
+    results = streamer.run(lambda d_job, series, part, folder: {"status": "ok", "job": id(d_job)})
+    assert cube.asked == [["1.1"]]
+    assert results[first] == [{"status": "ok", "job": id(first)}]
+    assert results[second] == [{"status": "ok", "job": id(second)}]
+
+
+def test_gives_up_stalled_series():
+    d_job = job(("1.1", 5))
+    streamer = SeriesStreamer(FakeCube([{"1.1": (1, "")}] * 3), poll_interval=0, stall_timeout=-1)
+    streamer.add(d_job)
+
+    results = streamer.run(lambda *args: {"status": "ok"})
+    assert results[d_job][0]["status"] == "Failed"
+    assert "stalled at 1/5" in results[d_job][0]["error"]
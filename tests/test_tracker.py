@@ -0,0 +1,103 @@
+import time
+
+from tracker import WorkflowTracker
+from transport import deadline, remaining
+
+
+class FakePipe:
+    """
+    Workflows finish after ``rounds`` status polls, or fail with ``failed``
+    """
+
+    def __init__(self, rounds=1, failed=()):
+        self.rounds = rounds
+        self.failed = set(failed)
+        self.polls = {}
+        self.deadlines = []
+        self.cancelled = []
+        self.notified = []
+        self.forgotten = []
+
+    def resolve_pipeline(self, name):
+        return {"leaf_titles": [], "total_jobs": 2}
+
+    def _get_workflow_status(self, workflow_id):
+        self.deadlines.append(remaining())
+        self.polls[workflow_id] = self.polls.get(workflow_id, 0) + 1
+        failed = workflow_id in self.failed
+        done = failed or self.polls[workflow_id] >= self.rounds
+        return {"workflow_failed": failed, "total_jobs": 2, "pending_jobs": 0, "running_jobs": 0 if done else 1,
+                "finished_jobs": 1 if failed else 2 * done, "errored_jobs": int(failed), "cancelled_jobs": 0}
+
+    def cancel_workflow(self, workflow_id):
+        self.cancelled.append(workflow_id)
+        return [workflow_id * 10]
+
+    def run_notification_plugin(self, *args):
+        self.notified.append(args)
+
+    def forget_workflow(self, workflow_id, leaf_titles):
+        self.forgotten.append(workflow_id)
+
+
+def test_polls_run_outside_the_row_deadline():
+    pipe = FakePipe()
+    tracker = WorkflowTracker(pipe, interval=0.05)
+    with deadline(0.01):
+        tracker.add(1, "anonymize")
+    time.sleep(0.02)
+    tracker.wait()
+    assert pipe.deadlines == [None]
+    assert tracker.summary([1])["status"] == "finished"
+
+
+def test_workflows_run_until_terminal_and_failures_are_notified():
+    pipe = FakePipe(rounds=2, failed=[2])
+    tracker = WorkflowTracker(pipe, interval=0.01)
+    tracker.add(1, "anonymize", submitted=time.time() - 5)
+    tracker.add(2, "anonymize", notify=(7, "a@b.c", "smtp", "{}"))
+    assert tracker.summary([1])["status"] == "running"
+
+    l_round = []
+    tracker.wait(on_poll=lambda: l_round.append(tracker.pending()))
+    assert l_round[0] == [1] and l_round[-1] == []
+    assert pipe.polls == {1: 2, 2: 1}
+    assert pipe.notified == [(7, "Pipeline failed with errors", "a@b.c", "smtp", "{}")]
+    assert pipe.cancelled == []
+
+    d_summary = tracker.summary([1, 2])
+    assert d_summary["status"] == "errored"
+    assert d_summary["workflow_id"] == "1,2"
+    assert d_summary["duration_s"] >= 5
+    assert (d_summary["finished_jobs"], d_summary["errored_jobs"]) == (3, 1)
+    assert [state for _, state, _ in tracker.durations([1, 2])] == ["finished", "errored"]
+
+
+def test_failed_workflow_cancels_its_siblings():
+    pipe = FakePipe(rounds=3, failed=[1])
+    tracker = WorkflowTracker(pipe, cancel_siblings=True, interval=0.01)
+    tracker.add(1, "anonymize", group="study-A")
+    tracker.add(2, "anonymize", group="study-A")
+    tracker.add(3, "anonymize", group="study-B")
+    tracker.wait()
+
+    assert pipe.cancelled == [1, 2]
+    assert sorted(pipe.forgotten) == [1, 2, 3]
+    assert pipe.polls[3] == 3 and 2 not in pipe.polls
+    assert tracker.summary([2])["status"] == "cancelled"
+    assert tracker.summary([1, 2])["cancelled_instances"] == "10,20"
+    assert tracker.summary([3])["status"] == "finished"
+
+
+def test_stuck_workflows_time_out():
+    pipe = FakePipe(rounds=1000)
+    tracker = WorkflowTracker(pipe, interval=0.01, timeout=0.05)
+    tracker.add(1, "anonymize")
+    tracker.add(2, "anonymize", submitted=time.time() - 60)
+    start = time.monotonic()
+    tracker.wait()
+
+    assert time.monotonic() - start < 1
+    assert tracker.summary([1, 2])["status"] == "timed_out"
+    assert tracker.durations([1, 2]) == []
+    assert sorted(pipe.forgotten) == [1, 2]
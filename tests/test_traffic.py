@@ -0,0 +1,134 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import transport
+from traffic import TrafficRecorder, TrafficReplayer
+from transport import TransportAdapter
+
+
+class Echo(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        time.sleep(0.2)
+        self.send_response(201)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def session():
+    session = requests.Session()
+    session.mount('http://', TransportAdapter())
+    yield session
+    transport.use_traffic(None)
+
+
+def test_record_and_replay(tmp_path, session):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Echo)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{httpd.server_port}/api/v1/'
+
+    recorder = TrafficRecorder(tmp_path / 'traffic.jsonl')
+    transport.use_traffic(recorder)
+    response = session.post(url, json={'PatientID': '1234567', 'Modality': 'MR'})
+    assert response.json()['PatientID'] == '1234567'
+    recorder.close()
+    httpd.shutdown()
+    httpd.server_close()
+
+    entry = json.loads((tmp_path / 'traffic.jsonl').read_text())
+    assert '1234567' not in json.dumps(entry)
+    assert entry['status'] == 201 and entry['elapsed'] >= 0.2
+
+    transport.use_traffic(TrafficReplayer(tmp_path / 'traffic.jsonl', speed=4))
+    start = time.monotonic()
+    for _ in range(2):
+        replayed = session.post(url, json={'PatientID': '1234567', 'Modality': 'MR'})
+        assert replayed.status_code == 201
+        assert replayed.json() == {'PatientID': '***', 'Modality': 'MR'}
+    assert 0.1 <= time.monotonic() - start < 0.2
+    with pytest.raises(requests.ConnectionError):
+        session.post(url, json={'PatientID': '1234567', 'Modality': 'CT'})
+
+
+PFDCM_STATUS = {
+    'status': True,
+    'pypx': {'data': [{
+        'PatientID': {'tag': '0x0010,0x0020', 'value': '1234567', 'label': 'PatientID'},
+        'PatientName': {'tag': '0x0010,0x0010', 'value': 'DOE^JANE', 'label': 'PatientName'},
+        'series': [{
+            'PatientBirthDate': {'tag': '0x0010,0x0030', 'value': '19800101', 'label': 'PatientBirthDate'},
+            'SeriesInstanceUID': {'tag': '0x0020,0x000e', 'value': '1.2.3', 'label': 'SeriesInstanceUID'},
+            'NumberOfSeriesRelatedInstances': {'tag': '0x0020,0x1209', 'value': '42', 'label': 'Number'}
+        }]
+    }]}
+}
+CUBE_SERIES = {'collection': {'items': [{'data': [{'name': 'PatientID', 'value': '1234567'},
+                                                  {'name': 'SeriesInstanceUID', 'value': '1.2.3'}]}]}}
+WORKFLOW = {'previous_plugin_inst_id': 3,
+            'nodes_info': json.dumps([{'title': 'PACS-query', 'plugin_parameter_defaults': [
+                {'name': 'PACSdirective', 'default': json.dumps({'PatientID': '1234567'})}]}])}
+
+
+class Stub(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps(PFDCM_STATUS if self.path.startswith('/PACS') else {}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        body = json.dumps(CUBE_SERIES).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_recording_is_scrubbed_structurally(tmp_path, session):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Stub)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{httpd.server_port}'
+    directive = {'PACSdirective': {'PatientID': '1234567', 'then': 'status'}}
+
+    recorder = TrafficRecorder(tmp_path / 'traffic.jsonl')
+    transport.use_traffic(recorder)
+    session.post(f'{url}/PACS/sync/pypx/', json=directive)
+    session.get(f'{url}/api/v1/pacs/series/search/?PatientID=1234567&limit=1')
+    session.post(f'{url}/api/v1/pipelines/1/workflows/', json=WORKFLOW)
+    recorder.close()
+    httpd.shutdown()
+    httpd.server_close()
+
+    recording = (tmp_path / 'traffic.jsonl').read_text()
+    for phi in ('1234567', 'DOE^JANE', '19800101'):
+        assert phi not in recording
+    for line in recording.splitlines():
+        entry = json.loads(line)
+        json.loads(entry['body'])
+        if entry['method'] == 'POST':
+            json.loads(entry['request'])
+
+    transport.use_traffic(TrafficReplayer(tmp_path / 'traffic.jsonl', speed=0))
+    status = session.post(f'{url}/PACS/sync/pypx/', json=directive).json()
+    series = status['pypx']['data'][0]['series'][0]
+    assert series['SeriesInstanceUID']['value'] == '1.2.3'
+    assert series['PatientBirthDate'] == {'tag': '0x0010,0x0030', 'value': '***', 'label': 'PatientBirthDate'}
+    items = session.get(f'{url}/api/v1/pacs/series/search/?PatientID=1234567&limit=1').json()
+    assert items['collection']['items'][0]['data'][0] == {'name': 'PatientID', 'value': '***'}
+    assert session.post(f'{url}/api/v1/pipelines/1/workflows/', json=WORKFLOW).status_code == 200
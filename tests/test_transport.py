@@ -0,0 +1,48 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from transport import DeadlineExceeded, TransportAdapter, deadline
+
+
+class StallOnce(BaseHTTPRequestHandler):
+    stalled = False
+
+    def do_GET(self):
+        if self.path == '/stall' and not StallOnce.stalled:
+            StallOnce.stalled = True
+            time.sleep(2)
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), StallOnce)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+
+
+def test_stalled_lookup_is_hedged_and_deadline_fails_fast(server):
+    session = requests.Session()
+    session.mount('http://', TransportAdapter(hedge_budget=0.5))
+    for _ in range(20):
+        session.get(f'{server}/fast', timeout=5)
+
+    start = time.perf_counter()
+    assert session.get(f'{server}/stall', timeout=5).text == 'ok'
+    assert time.perf_counter() - start < 1.5
+
+    with deadline(0.01):
+        time.sleep(0.02)
+        with pytest.raises(DeadlineExceeded):
+            session.get(f'{server}/fast', timeout=5)
@@ -0,0 +1,51 @@
+import pandas as pd
+
+from validation import validate_frame
+
+SEARCH_COLS = [('search_PatientID', 'PatientID'), ('search_StudyDate', 'StudyDate')]
+
+
+def sheet(**columns) -> pd.DataFrame:
+    base = {
+        'search_PatientID': ['1'],
+        'search_StudyDate': ['20200101'],
+        'Folder name': ['f'],
+        'Dicom path': ['d'],
+        'Dicom anonymized path': ['a'],
+        'Nifti path': ['n'],
+    }
+    base.update(columns)
+    return pd.DataFrame(base)
+
+
+def test_normalizes_ids_and_dates():
+    df = sheet(search_PatientID=[' 12 34 '], search_StudyDate=['2020-01-02'])
+    valid, rejected, duplicates, skipped = validate_frame(df, SEARCH_COLS)
+
+    assert rejected.empty and duplicates.empty
+    assert valid.iloc[0]['search_PatientID'] == '1234'
+    assert valid.iloc[0]['search_StudyDate'] == '20200102'
+
+
+def test_rejects_malformed_rows_with_a_reason():
+    df = sheet(**{
+        'search_PatientID': ['1', '2', '3', '3'],
+        'search_StudyDate': ['not a date', '20200101-20200201', '20200101', '20200101'],
+        'Folder name': ['f', '', 'f', 'f'],
+        'Dicom path': ['d'] * 4,
+        'Dicom anonymized path': ['a'] * 4,
+        'Nifti path': ['n'] * 4,
+    })
+    valid, rejected, duplicates, skipped = validate_frame(df, SEARCH_COLS)
+
+    assert valid['search_PatientID'].tolist() == ['3']
+    assert rejected['reason'].tolist() == ["bad StudyDate 'search_StudyDate'", "empty 'Folder name'"]
+    assert duplicates['duplicate_of'].tolist() == [3]
+
+
+def test_skips_unselected_rows():
+    df = sheet(select=['no']).iloc[:, ::-1]
+    valid, rejected, duplicates, skipped = validate_frame(df, SEARCH_COLS, skip_unselected=True)
+
+    assert valid.empty and rejected.empty and duplicates.empty
+    assert skipped['select'].tolist() == ['no']
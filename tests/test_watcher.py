@@ -0,0 +1,19 @@
+import threading
+from pathlib import Path
+
+from watcher import SheetWatcher
+
+
+def test_watcher_yields_existing_then_new_sheets(tmp_path: Path):
+    (tmp_path / 'first.csv').write_text('a\n1\n')
+    watcher = SheetWatcher(tmp_path, '**/*csv', interval=0.05, idle_timeout=1)
+
+    def drop():
+        (tmp_path / 'sub').mkdir()
+        (tmp_path / 'sub' / 'third.csv').write_text('a\n3\n')
+        (tmp_path / 'second.csv').write_text('a\n2\n')
+    threading.Timer(0.2, drop).start()
+
+    l_seen = [path.name for l_ready in watcher for path in l_ready]
+    assert l_seen[0] == 'first.csv'
+    assert sorted(l_seen[1:]) == ['second.csv', 'third.csv']
@@ -0,0 +1,254 @@
+import contextvars
+import threading
+import time
+from requests.exceptions import HTTPError
+from loguru import logger
+
+LOG = logger.debug
+
+TERMINAL_STATES = ("finished", "errored", "cancelled", "timed_out")
+
+# Fields of a row's `WorkflowTracker.summary`
+SUMMARY_FIELDS = ("status", "workflow_id", "duration_s", "finished_jobs", "errored_jobs", "cancelled_jobs",
+                  "cancelled_instances")
+
+
+class WorkflowTracker:
+    """
+    Shared in-memory state table of the workflows submitted during a run.
+
+    Every workflow is tracked from submission until it reaches a terminal
+    state (finished, errored or cancelled) together with its final job
+    counts, so per-row outcomes and wall-clock durations can be reported.
+    A background thread polls the pending workflows every ``interval``
+    seconds while there are any; the recipients given with a workflow are
+    notified if it fails. Workflows still pending ``timeout`` seconds after
+    their submission are given up as timed out (never if 0).
+
+    With ``cancel_failed``, the queued plugin instances of a failed workflow
+    are cancelled; with ``cancel_siblings``, so are the workflows of the
+    same group (rows sharing the failed search directive).
+    """
+
+    def __init__(self, pipe, cancel_failed: bool = False, cancel_siblings: bool = False, interval: float = 20,
+                 timeout: float = 0):
+        self.pipe = pipe
+        self.cancel_failed = cancel_failed or cancel_siblings
+        self.cancel_siblings = cancel_siblings
+        self.interval = interval
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.workflows = {}
+        # signalled after every round of polls
+        self.cond = threading.Condition()
+        self.rounds = 0
+        self.thread = None
+
+    def add(self, workflow_id: int, pipeline_name: str, group: str = None, notify: tuple = None,
+            submitted: float = None):
+        """
+        Start tracking a workflow posted at ``submitted`` (now by default).
+        ``notify`` holds the (previous instance, recipients, SMTP server,
+        search directive) of the notification sent if it fails.
+        """
+        with self.lock:
+            self.workflows.setdefault(workflow_id, {
+                "pipeline": pipeline_name,
+                "group": group,
+                "notify": notify,
+                "state": "running",
+                "submitted": submitted or time.time(),
+                "completed": None,
+                "finished_jobs": 0,
+                "errored_jobs": 0,
+                "cancelled_jobs": 0,
+                "cancelled_instances": []
+            })
+        with self.cond:
+            self._start()
+
+    def _start(self):
+        # with self.cond held
+        if self.thread is None:
+            # polls run in a fresh context, outside the row deadline of the caller
+            self.thread = threading.Thread(target=contextvars.Context().run, args=(self._run,),
+                                           name="workflow-tracker", daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        """
+        Poll the pending workflows every ``interval`` seconds until none is left
+        """
+        while True:
+            time.sleep(self.interval)
+            l_pending = self.pending()
+            LOG(f"Polling {len(l_pending)} workflows")
+            for workflow_id in l_pending:
+                try:
+                    self.poll(workflow_id)
+                except Exception as ex:
+                    LOG(f"Polling workflow {workflow_id} failed: {ex}")
+            self.expire()
+            with self.cond:
+                self.rounds += 1
+                self.cond.notify_all()
+                if not self.pending():
+                    self.thread = None
+                    return
+
+    def expire(self):
+        """
+        Give up the workflows still pending ``timeout`` seconds after their submission
+        """
+        if not self.timeout:
+            return
+        now = time.time()
+        with self.lock:
+            l_expired = [workflow_id for workflow_id, record in self.workflows.items()
+                         if record["state"] not in TERMINAL_STATES and now - record["submitted"] > self.timeout]
+            for workflow_id in l_expired:
+                self.workflows[workflow_id]["state"] = "timed_out"
+        for workflow_id in l_expired:
+            LOG(f"Workflow {workflow_id} still pending after {self.timeout}s, giving up")
+            template = self.pipe.resolve_pipeline(self.workflows[workflow_id]["pipeline"])
+            self.pipe.forget_workflow(workflow_id, template["leaf_titles"])
+
+    def pending(self) -> list[int]:
+        with self.lock:
+            return [workflow_id for workflow_id, record in self.workflows.items()
+                    if record["state"] not in TERMINAL_STATES]
+
+    def poll(self, workflow_id: int):
+        """
+        Poll a workflow once and record its state. Only the leaf instances
+        are checked while the workflow runs; the full workflow record is
+        fetched once it is done, for the final job counts.
+        """
+        record = self.workflows[workflow_id]
+        # e.g. cancelled with a failed sibling earlier in the round
+        if record["state"] in TERMINAL_STATES:
+            return
+        template = self.pipe.resolve_pipeline(record["pipeline"])
+        leaf_titles = template["leaf_titles"]
+        if leaf_titles:
+            status = self.pipe._get_workflow_leaf_status(workflow_id, leaf_titles)
+            if not (status["workflow_failed"]
+                    or status["finished_jobs"] >= len(leaf_titles)
+                    or status["total_jobs"] < len(leaf_titles)):
+                return
+
+        try:
+            status = self.pipe._get_workflow_status(workflow_id)
+        except HTTPError as ex:
+            if ex.response is None or ex.response.status_code != 404:
+                raise
+            status = {"workflow_failed": True, "finished_jobs": 0, "errored_jobs": 0, "cancelled_jobs": 0}
+
+        message = "Pipeline failed with errors"
+        if status["workflow_failed"]:
+            state = "errored" if status["errored_jobs"] else "cancelled"
+        elif status["pending_jobs"] or status["running_jobs"]:
+            return
+        elif status["total_jobs"] < template["total_jobs"]:
+            state = "cancelled"
+            message = "Nodes deleted in pipeline"
+        else:
+            state = "finished"
+
+        with self.lock:
+            record.update({
+                "state": state,
+                "completed": time.time(),
+                "finished_jobs": status["finished_jobs"],
+                "errored_jobs": status["errored_jobs"],
+                "cancelled_jobs": status["cancelled_jobs"]
+            })
+        LOG(f"Workflow {workflow_id} {state}")
+        self.pipe.forget_workflow(workflow_id, leaf_titles)
+        if state == "finished":
+            return
+        if self.cancel_failed:
+            self.cancel(workflow_id)
+        if record["notify"]:
+            previous_inst, recipients, smtp_server, search_data = record["notify"]
+            try:
+                self.pipe.run_notification_plugin(previous_inst, message, recipients, smtp_server, search_data)
+            except Exception as ex:
+                LOG(f"Notifying the failure of workflow {workflow_id} failed: {ex}")
+
+    def cancel(self, workflow_id: int):
+        """
+        Free the compute of a failed workflow: cancel its queued plugin
+        instances and, with ``cancel_siblings``, the running workflows of
+        its group
+        """
+        record = self.workflows[workflow_id]
+        l_cancelled = self.pipe.cancel_workflow(workflow_id)
+        with self.lock:
+            record["cancelled_instances"].extend(l_cancelled)
+            l_sibling = [sibling_id for sibling_id, sibling in self.workflows.items()
+                         if self.cancel_siblings and record["group"] is not None
+                         and sibling["group"] == record["group"] and sibling["state"] == "running"]
+        for sibling_id in l_sibling:
+            l_cancelled = self.pipe.cancel_workflow(sibling_id)
+            with self.lock:
+                self.workflows[sibling_id].update({"state": "cancelled", "completed": time.time()})
+                self.workflows[sibling_id]["cancelled_instances"].extend(l_cancelled)
+            sibling_pipeline = self.pipe.resolve_pipeline(self.workflows[sibling_id]["pipeline"])
+            self.pipe.forget_workflow(sibling_id, sibling_pipeline["leaf_titles"])
+            LOG(f"Workflow {sibling_id} cancelled with failed workflow {workflow_id}")
+
+    def wait(self, l_workflow_id: list[int] = None, on_poll=None):
+        """
+        Block until the given workflows (all by default) reach a terminal
+        state, calling ``on_poll()`` after every round of polls
+        """
+        def waiting() -> list[int]:
+            l_pending = self.pending()
+            if l_workflow_id is None:
+                return l_pending
+            return [workflow_id for workflow_id in l_pending if workflow_id in set_id]
+
+        set_id = set(l_workflow_id or ())
+        while True:
+            with self.cond:
+                l_waiting = waiting()
+                if not l_waiting:
+                    return
+                LOG(f"Waiting for {len(l_waiting)} workflows")
+                self._start()
+                rounds = self.rounds
+                self.cond.wait_for(lambda: self.rounds != rounds)
+            if on_poll:
+                on_poll()
+
+    def durations(self, l_workflow_id: list[int]) -> list[tuple]:
+        """
+        The (pipeline name, final state, duration) of the completed
+        workflows among ``l_workflow_id``
+        """
+        with self.lock:
+            l_record = [self.workflows[workflow_id] for workflow_id in l_workflow_id]
+        return [(record["pipeline"], record["state"], record["completed"] - record["submitted"])
+                for record in l_record if record["completed"]]
+
+    def summary(self, l_workflow_id: list[int]) -> dict:
+        """
+        Aggregate the final state of the workflows of one row
+        """
+        with self.lock:
+            l_record = [self.workflows[workflow_id] for workflow_id in l_workflow_id]
+        states = [record["state"] for record in l_record]
+        state = next((s for s in ("errored", "cancelled", "timed_out", "running") if s in states), "finished")
+        completed = [record["completed"] for record in l_record if record["completed"]]
+        return {
+            "status": state,
+            "workflow_id": ",".join(str(workflow_id) for workflow_id in l_workflow_id),
+            "duration_s": round(max(completed) - min(record["submitted"] for record in l_record), 1)
+                        if completed else "",
+            "finished_jobs": sum(record["finished_jobs"] for record in l_record),
+            "errored_jobs": sum(record["errored_jobs"] for record in l_record),
+            "cancelled_jobs": sum(record["cancelled_jobs"] for record in l_record),
+            "cancelled_instances": ",".join(str(instance_id) for record in l_record
+                                            for instance_id in record["cancelled_instances"])
+        }
@@ -0,0 +1,158 @@
+import collections
+import datetime
+import json
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+import requests
+from requests.structures import CaseInsensitiveDict
+from loguru import logger
+from log_config import mask_phi, redact
+
+LOG = logger.debug
+
+# Response headers kept in a recording, the others are dropped
+KEPT_HEADERS = ("Content-Type", "ETag", "Retry-After", "Location")
+
+# DICOM patient attributes masked wherever they appear in a recording
+PHI_TAGS = frozenset((
+    "PatientID", "PatientName", "PatientBirthDate", "PatientBirthTime", "PatientSex", "PatientAge",
+    "PatientAddress", "PatientTelephoneNumbers", "PatientMotherBirthName", "PatientComments",
+    "OtherPatientIDs", "OtherPatientNames", "OtherPatientIDsSequence", "AccessionNumber",
+    "ReferringPhysicianName", "PerformingPhysicianName"
+))
+MASK = "***"
+
+
+def _mask(value):
+    # pfdcm wraps DICOM values as {"tag": ..., "value": ..., "label": ...}
+    if isinstance(value, dict) and "value" in value:
+        return {**value, "value": _mask(value["value"])}
+    return MASK if value not in (None, "") else value
+
+
+def scrub(value):
+    """
+    Mask the PHI of a parsed JSON document: the values of ``PHI_TAGS``
+    keys, collection+json ``{"name": ..., "value": ...}`` fields of those
+    tags, JSON documents nested in strings (e.g. a workflow's nodes info)
+    and registered PHI values in any other string
+    """
+    if isinstance(value, dict):
+        if value.get("name") in PHI_TAGS and "value" in value:
+            return {**value, "value": _mask(value["value"])}
+        return {key: _mask(item) if key in PHI_TAGS else scrub(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    if isinstance(value, str):
+        if value[:1] in ("{", "["):
+            try:
+                return json.dumps(scrub(json.loads(value)))
+            except ValueError:
+                pass
+        return mask_phi(value)
+    return value
+
+
+def _body(data) -> str:
+    if data is None:
+        return ""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8", errors="replace")
+    try:
+        return json.dumps(scrub(json.loads(data)))
+    except ValueError:
+        return redact(data)
+
+
+def _url(url: str) -> str:
+    parts = urlsplit(url)
+    query = urlencode([(key, _mask(value) if key in PHI_TAGS else mask_phi(value))
+                       for key, value in parse_qsl(parts.query, keep_blank_values=True)])
+    return parts._replace(path=mask_phi(parts.path), query=query).geturl()
+
+
+class TrafficRecorder:
+    """
+    Record every request sent through the transport, with its response and
+    latency, as one JSON line of ``path``. Request headers (the auth
+    tokens) are left out and PHI is scrubbed from URLs and JSON bodies
+    (see ``scrub``).
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def send(self, request, transmit):
+        start = time.monotonic()
+        response = transmit()
+        elapsed = time.monotonic() - start
+        entry = {
+            "t": round(start - self.started, 6),
+            "elapsed": round(elapsed, 6),
+            "method": request.method,
+            "url": _url(request.url),
+            "request": _body(request.body),
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": {name: response.headers[name] for name in KEPT_HEADERS if name in response.headers},
+            "body": _body(response.content)
+        }
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+        return response
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class TrafficReplayer:
+    """
+    Serve the responses of a ``TrafficRecorder`` file instead of the
+    network. Requests are matched on method, URL and body, scrubbed like
+    the recorded ones; repeated requests get the recorded responses in
+    order, then the last one again (e.g. extra status polls). Each
+    response is delayed by its recorded latency divided by ``speed`` (no
+    delay if 0).
+    """
+
+    def __init__(self, path, speed: float = 1.0):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.entries = collections.defaultdict(collections.deque)
+        self.last = {}
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries[(entry["method"], entry["url"], entry["request"])].append(entry)
+        LOG(f"Replaying {sum(map(len, self.entries.values()))} recorded requests from {path}")
+
+    def send(self, request, transmit=None):
+        key = (request.method, _url(request.url), _body(request.body))
+        with self.lock:
+            if self.entries.get(key):
+                entry = self.last[key] = self.entries[key].popleft()
+            else:
+                entry = self.last.get(key)
+        if entry is None:
+            raise requests.ConnectionError(f"No recorded response for {request.method} {_url(request.url)}",
+                                           request=request)
+        if self.speed:
+            time.sleep(entry["elapsed"] / self.speed)
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = entry["reason"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response._content = entry["body"].encode()
+        response._content_consumed = True
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(seconds=entry["elapsed"])
+        return response
@@ -0,0 +1,161 @@
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+from loguru import logger
+from limiter import LimitedAdapter
+
+LOG = logger.debug
+
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+# Recorder or replayer of the traffic of every adapter, see `use_traffic`
+_traffic = None
+
+
+class DeadlineExceeded(Exception):
+    """
+    The time budget of a row ran out before a request could be sent
+    """
+
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """
+    Give the lookups of the calling thread or task ``seconds`` in total
+    (no limit if 0). The budget follows ``asyncio`` tasks and ``to_thread``.
+    """
+    if not seconds:
+        yield
+        return
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """
+    Seconds left in the current deadline, or ``None`` without one
+    """
+    end = _deadline.get()
+    return None if end is None else end - time.monotonic()
+
+
+def use_traffic(traffic):
+    """
+    Pass the requests of every ``TransportAdapter`` through ``traffic``, a
+    ``TrafficRecorder`` or ``TrafficReplayer`` (none if ``None``)
+    """
+    global _traffic
+    _traffic = traffic
+
+
+def _capped_timeout(timeout, left: float):
+    if timeout is None:
+        return left
+    if isinstance(timeout, tuple):
+        return tuple(left if t is None else min(t, left) for t in timeout)
+    return min(timeout, left)
+
+
+def _close_loser(future: concurrent.futures.Future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class TransportAdapter(LimitedAdapter):
+    """
+    The shared transport of the clients: requests go out under an optional
+    ``AdaptiveLimiter``, and idempotent lookups (GET/HEAD) additionally
+
+    - are cut to the time left in the caller's ``deadline``, failing fast
+      with ``DeadlineExceeded`` once it has passed, and
+    - are hedged if ``hedge_budget`` is set: a lookup still unanswered
+      after the p95 latency of recent lookups is sent a second time and
+      the first answer wins. Each lookup earns ``hedge_budget`` hedges, so
+      at most that fraction of the lookups is duplicated.
+
+    Other methods (e.g. posting workflows) are sent once, as they are.
+    Under ``use_traffic`` the requests are recorded or served from a
+    recording, below the limiter so that it sees the same latencies.
+    """
+
+    def __init__(self, limiter=None, hedge_budget: float = 0.0, min_samples: int = 20, **kwargs):
+        super().__init__(limiter, **kwargs)
+        self.hedge_budget = hedge_budget
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=200)
+        self.tokens = 0.0
+        self.lock = threading.Lock()
+        self.executor = None
+        if hedge_budget:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * kwargs.get("pool_maxsize", 10))
+
+    def send(self, request, **kwargs):
+        if request.method not in IDEMPOTENT_METHODS:
+            return super().send(request, **kwargs)
+
+        left = remaining()
+        if left is not None:
+            if left <= 0:
+                raise DeadlineExceeded(f"No time left for {request.method} {request.path_url}")
+            kwargs["timeout"] = _capped_timeout(kwargs.get("timeout"), left)
+        if self.executor is None:
+            return self._timed_send(request, kwargs)
+        return self._hedged_send(request, kwargs)
+
+    def transmit(self, request, **kwargs):
+        if _traffic is None:
+            return super().transmit(request, **kwargs)
+        return _traffic.send(request, functools.partial(super().transmit, request, **kwargs))
+
+    def _timed_send(self, request, kwargs):
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        with self.lock:
+            self.latencies.append(time.perf_counter() - start)
+        return response
+
+    def hedge_delay(self):
+        """
+        Earn the hedge budget of a lookup and return the p95 latency of
+        recent lookups, or ``None`` while there are too few of them
+        """
+        with self.lock:
+            self.tokens = min(10.0, self.tokens + self.hedge_budget)
+            if len(self.latencies) < self.min_samples:
+                return None
+            return sorted(self.latencies)[int(0.95 * (len(self.latencies) - 1))]
+
+    def _take_hedge(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def _hedged_send(self, request, kwargs):
+        delay = self.hedge_delay()
+        primary = self.executor.submit(self._timed_send, request, kwargs)
+        if delay is None:
+            return primary.result()
+        done, _ = concurrent.futures.wait([primary], timeout=delay)
+        if done or not self._take_hedge():
+            return primary.result()
+
+        LOG(f"Hedging {request.method} {request.path_url} after {delay:.2f}s")
+        hedge = self.executor.submit(self._timed_send, request.copy(), kwargs)
+        l_future = [primary, hedge]
+        winner = next((future for future in concurrent.futures.as_completed(l_future)
+                       if future.exception() is None), primary)
+        for future in l_future:
+            if future is not winner:
+                future.add_done_callback(_close_loser)
+        return winner.result()
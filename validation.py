@@ -0,0 +1,81 @@
+import pandas as pd
+from loguru import logger
+
+LOG = logger.debug
+
+# Columns required to build the anonymization and push parameters of a job
+REQUIRED_COLUMNS = ("Folder name", "Dicom path", "Dicom anonymized path", "Nifti path")
+
+# DICOM dates and date ranges accepted by PACS as is
+DICOM_DATE = r"^(\d{8}|\d{8}-\d{8}|\d{8}-|-\d{8})$"
+
+
+def canonical_dates(dates: pd.Series) -> pd.Series:
+    """
+    Convert dates to the DICOM ``YYYYMMDD`` format. Values already in DICOM
+    format (or DICOM ranges) and empty values are kept, unparseable values
+    become ``NaN``.
+    """
+    keep = dates.eq("") | dates.str.match(DICOM_DATE)
+    parsed = pd.to_datetime(dates.where(~keep), format="mixed", errors="coerce").dt.strftime("%Y%m%d")
+    return dates.where(keep, parsed)
+
+
+def validate_frame(df: pd.DataFrame, search_cols: list[tuple[str, str]],
+                   skip_unselected: bool = False) -> (pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame):
+    """
+    Normalize a cleaned request sheet and reject malformed rows up front.
+
+    1. Trim whitespace in every cell and inside PatientIDs
+    2. Optionally skip rows whose first column does not say 'yes'
+    3. Check that the required columns exist and are filled
+    4. Canonicalize StudyDates
+    5. Flag duplicated requests
+
+    Rows that were already pushed (non-empty status) are never rejected.
+    Returns the valid rows, a report of the rejected rows with a
+    ``reason`` column, the duplicated rows with a ``duplicate_of``
+    column (the number of the first of their rows, counting the data
+    rows of the sheet from 1) and the skipped rows.
+    """
+    df = df.apply(lambda col: col.str.strip())
+    reasons = pd.Series("", index=df.index)
+    skipped = df.iloc[:0]
+
+    if skip_unselected and len(df.columns):
+        selected = df[df.columns[0]].str.lower().eq("yes")
+        LOG(f"Skipping {int((~selected).sum())} rows not selected")
+        df, skipped, reasons = df[selected], df[~selected], reasons[selected]
+
+    status_cols = [col for col in df.columns if "status" in str(col).lower()]
+    pending = ~df[status_cols].ne("").any(axis=1) if status_cols else pd.Series(True, index=df.index)
+
+    def reject(mask: pd.Series, reason: str):
+        mask = mask & pending & reasons.eq("")
+        reasons[mask] = reason
+
+    for col in REQUIRED_COLUMNS:
+        if col not in df.columns:
+            reject(pd.Series(True, index=df.index), f"missing column '{col}'")
+        else:
+            reject(df[col].eq(""), f"empty '{col}'")
+
+    for col, key in search_cols:
+        if key == "PatientID":
+            df[col] = df[col].str.replace(r"\s+", "", regex=True)
+        if key == "StudyDate":
+            dates = canonical_dates(df[col])
+            reject(dates.isna(), f"bad StudyDate '{col}'")
+            df[col] = dates.fillna(df[col])
+
+    rejected = reasons.ne("")
+    duplicated = pd.Series(False, index=df.index)
+    first = pd.Series(df.index, index=df.index)
+    key_cols = [col for col, _ in search_cols] + [col for col in REQUIRED_COLUMNS if col in df.columns]
+    if key_cols:
+        duplicated = df.duplicated(subset=key_cols, keep="first") & pending & ~rejected
+        first = first.groupby([df[col] for col in key_cols], sort=False).transform("first")
+
+    valid = ~rejected & ~duplicated
+    return (df[valid], df[rejected].assign(reason=reasons[rejected]),
+            df[duplicated].assign(duplicate_of=first[duplicated] + 1), skipped)
@@ -0,0 +1,120 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+from pathlib import Path
+from loguru import logger
+
+LOG = logger.debug
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+# struct inotify_event header: wd, mask, cookie, len
+INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    Minimal binding of Linux inotify through libc, reporting the names of
+    files closed after writing or moved into a directory
+    """
+
+    def __init__(self, directory: Path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, str(directory).encode(), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"Cannot watch {directory}")
+
+    def read(self, timeout: float) -> set[str]:
+        """
+        Wait up to ``timeout`` seconds for events and return the file names
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            names.add(data[offset:offset + length].rstrip(b"\0").decode())
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SheetWatcher:
+    """
+    Iterate over the sheets landing in an input directory, in batches.
+
+    Sheets present at start are yielded right away. New sheets are ready
+    once inotify reports them closed (or moved in), or, for subdirectories
+    and systems without inotify, once their size and modification time
+    are unchanged between two scans. Iteration stops after ``idle_timeout``
+    seconds without new sheets (never if 0).
+    """
+
+    def __init__(self, directory: Path, pattern: str, interval: float = 5, idle_timeout: float = 0):
+        self.directory = Path(directory)
+        self.pattern = pattern
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.seen = set()
+        self.stats = {}
+        self.initial = set(self.directory.glob(self.pattern))
+        try:
+            self.inotify = Inotify(self.directory)
+        except (OSError, AttributeError) as ex:
+            LOG(f"inotify unavailable, polling {self.directory}: {ex}")
+            self.inotify = None
+
+    def ready(self, closed: set[str] = frozenset()) -> list[Path]:
+        """
+        The unseen sheets that are completely written
+        """
+        l_ready = []
+        for path in sorted(self.directory.glob(self.pattern)):
+            if path in self.seen or not path.is_file():
+                continue
+            stat = path.stat()
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if (path in self.initial
+                    or (path.parent == self.directory and path.name in closed)
+                    or self.stats.get(path) == signature):
+                self.seen.add(path)
+                self.stats.pop(path, None)
+                l_ready.append(path)
+            else:
+                self.stats[path] = signature
+        return l_ready
+
+    def wait(self) -> set[str]:
+        if self.inotify:
+            return self.inotify.read(self.interval)
+        time.sleep(self.interval)
+        return set()
+
+    def __iter__(self):
+        closed = set()
+        last_sheet = time.monotonic()
+        try:
+            while True:
+                l_ready = self.ready(closed)
+                if l_ready:
+                    last_sheet = time.monotonic()
+                    yield l_ready
+                elif self.idle_timeout and time.monotonic() - last_sheet > self.idle_timeout:
+                    LOG(f"No new sheets for {self.idle_timeout}s, stop watching")
+                    return
+                closed = self.wait()
+        finally:
+            if self.inotify:
+                self.inotify.close()